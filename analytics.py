@@ -0,0 +1,202 @@
+import heapq
+import time
+from collections import Counter, deque
+from backend import SmartPlug, SmartTV, SmartWashingMachine
+
+
+def home_contribution(smart_home):
+    current_load = 0
+    channels = []
+    wash_modes = []
+
+    for device in smart_home.devices:
+        if isinstance(device, SmartPlug):
+            if device.switched_on:
+                current_load += device.consumption_rate
+        elif isinstance(device, SmartTV):
+            if device.switched_on:
+                channels.append(device.channel)
+        elif isinstance(device, SmartWashingMachine):
+            wash_modes.append(device.wash_mode)
+
+    return current_load, channels, wash_modes
+
+
+class FleetAnalytics:
+
+    def __init__(self, window_seconds=60, clock=time.monotonic):
+        # smart_home_name -> (smart_home, listener, (current_load, channels, wash_modes))
+        self.tracked = {}
+        self.channel_counter = Counter()
+        self.wash_mode_counter = Counter()
+        self.total_load = 0
+
+        # max-heap of (-current_load, smart_home_name, stamp), entries with an old stamp are stale
+        self.load_heap = []
+        self.load_stamps = {}
+        self.next_stamp = 0
+
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self.load_changes = deque()
+        self.window_net_change = 0
+        self.window_absolute_change = 0
+
+    def track(self, smart_home_name, smart_home):
+        self.untrack(smart_home_name)
+
+        def listener(smart_home, event, index, device):
+            self.refresh(smart_home_name)
+
+        smart_home.listeners.append(listener)
+        self.tracked[smart_home_name] = (smart_home, listener, (0, [], []))
+        self.refresh(smart_home_name, record_change=False)
+
+    def untrack(self, smart_home_name):
+        if smart_home_name not in self.tracked:
+            return
+
+        smart_home, listener, contribution = self.tracked.pop(smart_home_name)
+        if listener in smart_home.listeners:
+            smart_home.listeners.remove(listener)
+
+        self.apply_contribution(contribution, -1)
+        # the heap entry becomes stale once the stamp is gone
+        del self.load_stamps[smart_home_name]
+        self.compact_heap()
+
+    def refresh(self, smart_home_name, record_change=True):
+        smart_home, listener, old_contribution = self.tracked[smart_home_name]
+        new_contribution = home_contribution(smart_home)
+
+        self.apply_contribution(old_contribution, -1)
+        self.apply_contribution(new_contribution, 1)
+        self.tracked[smart_home_name] = (smart_home, listener, new_contribution)
+
+        load_change = new_contribution[0] - old_contribution[0]
+        if record_change and load_change:
+            self.record_load_change(load_change)
+
+        if smart_home_name not in self.load_stamps or load_change:
+            self.next_stamp += 1
+            self.load_stamps[smart_home_name] = self.next_stamp
+            heapq.heappush(self.load_heap, (-new_contribution[0], smart_home_name, self.next_stamp))
+            self.compact_heap()
+
+    def apply_contribution(self, contribution, sign):
+        current_load, channels, wash_modes = contribution
+        self.total_load += sign * current_load
+        for channel in channels:
+            self.channel_counter[channel] += sign
+            if self.channel_counter[channel] == 0:
+                del self.channel_counter[channel]
+        for wash_mode in wash_modes:
+            self.wash_mode_counter[wash_mode] += sign
+            if self.wash_mode_counter[wash_mode] == 0:
+                del self.wash_mode_counter[wash_mode]
+
+    def compact_heap(self):
+        if len(self.load_heap) > 2 * len(self.load_stamps) + 64:
+            self.load_heap = [
+                entry for entry in self.load_heap
+                if self.load_stamps.get(entry[1]) == entry[2]
+            ]
+            heapq.heapify(self.load_heap)
+
+    def top_homes_by_load(self, k=20):
+        # pop the k largest live entries and push them back, stale entries are dropped on the way
+        result = []
+        popped = []
+        while self.load_heap and len(result) < k:
+            entry = heapq.heappop(self.load_heap)
+            if self.load_stamps.get(entry[1]) == entry[2]:
+                popped.append(entry)
+                result.append((entry[1], -entry[0]))
+
+        for entry in popped:
+            heapq.heappush(self.load_heap, entry)
+        return result
+
+    def current_load(self, smart_home_name):
+        return self.tracked[smart_home_name][2][0]
+
+    def channel_popularity(self, k=None):
+        return self.channel_counter.most_common(k)
+
+    def wash_mode_mix(self):
+        return dict(self.wash_mode_counter)
+
+    def record_load_change(self, load_change):
+        now = self.clock()
+        self.load_changes.append((now, load_change))
+        self.window_net_change += load_change
+        self.window_absolute_change += abs(load_change)
+        self.expire_load_changes(now)
+
+    def expire_load_changes(self, now):
+        while self.load_changes and self.load_changes[0][0] <= now - self.window_seconds:
+            timestamp, load_change = self.load_changes.popleft()
+            self.window_net_change -= load_change
+            self.window_absolute_change -= abs(load_change)
+
+    def rolling_consumption(self):
+        self.expire_load_changes(self.clock())
+        return {
+            "window_seconds": self.window_seconds,
+            "changes": len(self.load_changes),
+            "net_change": self.window_net_change,
+            "absolute_change": self.window_absolute_change,
+            "change_rate": self.window_absolute_change / self.window_seconds,
+            "total_load": self.total_load,
+        }
+
+
+def benchmark_analytics(number_of_homes=100000, number_of_updates=100000):
+    import random
+    from fleetgen import FleetGenerator
+
+    random.seed(1)
+    smart_homes = dict(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+
+    analytics = FleetAnalytics()
+    start = time.perf_counter()
+    for smart_home_name, smart_home in smart_homes.items():
+        analytics.track(smart_home_name, smart_home)
+    track_time = time.perf_counter() - start
+
+    smart_home_list = list(smart_homes.values())
+    start = time.perf_counter()
+    for i in range(number_of_updates):
+        smart_home = random.choice(smart_home_list)
+        index = random.randrange(len(smart_home.devices))
+        device = smart_home.devices[index]
+        if isinstance(device, SmartPlug):
+            smart_home.update_option(index, random.randint(0, 150))
+        elif isinstance(device, SmartTV):
+            smart_home.update_option(index, random.randint(1, 734))
+        else:
+            smart_home.update_option(index, random.choice(SmartWashingMachine.wash_modes))
+    update_time = (time.perf_counter() - start) / number_of_updates
+
+    start = time.perf_counter()
+    for i in range(100):
+        analytics.top_homes_by_load(20)
+        analytics.channel_popularity(10)
+        analytics.wash_mode_mix()
+    query_time = (time.perf_counter() - start) / 100
+
+    # the same dashboard computed by scanning every home
+    start = time.perf_counter()
+    loads = [(home_contribution(smart_home)[0], smart_home_name) for smart_home_name, smart_home in smart_homes.items()]
+    sorted(loads, reverse=True)[:20]
+    scan_time = time.perf_counter() - start
+
+    print(f"Analytics with {number_of_homes} homes:")
+    print(f"Tracking all homes: {track_time:.3f}s")
+    print(f"Update including analytics: {update_time * 1000000:.1f}us")
+    print(f"Top 20, channel popularity and wash mode mix: {query_time * 1000:.3f}ms")
+    print(f"Top 20 by full scan: {scan_time * 1000:.3f}ms")
+    print(f"Rolling window: {analytics.rolling_consumption()}")
+
+
+#benchmark_analytics()
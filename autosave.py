@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+from savefile import smart_home_to_csv_line, compression_for, open_save_file
+
+
+class AutoSaver:
+
+    def __init__(self, file_name, get_smart_homes, interval=30, sparse=False, level=None):
+        # get_smart_homes returns a list of (smart_home_name, smart_home) pairs, level is the
+        # compression level used when the file name ends in .gz or .xz
+        self.file_name = file_name
+        self.sparse = sparse
+        self.level = level
+        self.get_smart_homes = get_smart_homes
+        self.interval = interval
+
+        # smart_home_name -> (smart_home, version, csv line) as of the last successful save, the
+        # home object is kept so a different home loaded under the same name is never clean
+        self.saved_lines = {}
+        self.saved_names = None
+
+        self.reports = []
+        self.report_callback = None
+
+        self.save_lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.final_save = True
+        self.final_report = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="AutoSaver", daemon=True)
+            self.thread.start()
+
+    def stop(self, final_save=True, wait=True):
+        # the final save runs on the worker, with wait=False this returns straight away and
+        # the final report only reaches report_callback
+        self.final_save = final_save
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is None:
+            return self.save_now() if final_save else None
+        if wait:
+            self.thread.join()
+            self.thread = None
+            return self.final_report
+        return None
+
+    def request_save(self):
+        # called from the Tk thread, the worker does the actual writing
+        self.wake_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.wake_event.wait(self.interval)
+            self.wake_event.clear()
+            if self.stop_event.is_set():
+                break
+            self.save_now()
+        if self.final_save:
+            self.final_report = self.save_now()
+
+    def save_now(self):
+        with self.save_lock:
+            start = time.perf_counter()
+            smart_homes = list(self.get_smart_homes())
+            names = [smart_home_name for smart_home_name, smart_home in smart_homes]
+
+            new_saved_lines = {}
+            lines = []
+            homes_written = 0
+            homes_skipped = 0
+            homes_unstable = 0
+
+            for smart_home_name, smart_home in smart_homes:
+                version = smart_home.version
+                saved = self.saved_lines.get(smart_home_name)
+
+                if saved and saved[0] is smart_home and saved[1] == version:
+                    line = saved[2]
+                    homes_skipped += 1
+                else:
+                    line, version = self.serialize(smart_home_name, smart_home, saved)
+                    if line is None:
+                        homes_unstable += 1
+                        continue
+                    homes_written += 1
+
+                # a home still changing while it was serialized stays dirty for the next cycle
+                if smart_home.version == version:
+                    new_saved_lines[smart_home_name] = (smart_home, version, line)
+                lines.append(line)
+
+            # a home that never held still long enough has no line to write, so this cycle
+            # leaves the file as it is rather than drop the home from it or write a torn line
+            bytes_written = 0
+            error = None
+            if homes_unstable:
+                pass
+            elif homes_written or names != self.saved_names:
+                try:
+                    bytes_written = self.write_atomic("".join(lines))
+                except OSError as e:
+                    # nothing was saved, so the next cycle tries every home again
+                    error = str(e)
+
+            if error is None and not homes_unstable:
+                self.saved_lines = new_saved_lines
+                self.saved_names = names
+
+            report = {
+                "latency": time.perf_counter() - start,
+                "bytes_written": bytes_written,
+                "homes_written": homes_written,
+                "homes_skipped": homes_skipped,
+                "homes_unstable": homes_unstable,
+                "error": error,
+                # the file holds exactly these homes as they are now, no line was stale or torn
+                "complete": error is None and not homes_unstable and len(new_saved_lines) == len(smart_homes),
+            }
+            self.reports.append(report)
+            if self.report_callback:
+                self.report_callback(report)
+            return report
+
+    def serialize(self, smart_home_name, smart_home, saved, attempts=20, retry_delay=0.001):
+        # the Tk thread may change the home while this thread reads it, a line is only kept
+        # if the version was the same before and after, otherwise the last saved line is used,
+        # and (None, None) means there is no untorn line of this home to write yet
+        for i in range(attempts):
+            version = smart_home.version
+            line = smart_home_to_csv_line(smart_home_name, smart_home, self.sparse)
+            if smart_home.version == version:
+                return line, version
+            time.sleep(retry_delay)
+        if saved and saved[0] is smart_home:
+            return saved[2], saved[1]
+        return None, None
+
+    def write_atomic(self, text):
+        # the temporary file keeps the compression of the real save file
+        temp_file_name = f"{self.file_name}.tmp"
+
+        with open_save_file(temp_file_name, "w", compression_for(self.file_name), self.level) as file:
+            file.write(text)
+        with open(temp_file_name, "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(temp_file_name, self.file_name)
+
+        return os.path.getsize(self.file_name)
+
+
+def benchmark_autosave(number_of_homes=100000, number_of_changed_homes=100):
+    import random
+    import tempfile
+    from fleetgen import FleetGenerator
+
+    random.seed(1)
+    smart_homes = list(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+
+    file_name = os.path.join(tempfile.mkdtemp(), "autosave.csv")
+    auto_saver = AutoSaver(file_name, lambda: smart_homes)
+
+    def print_report(cycle, report):
+        print(
+            f"{cycle}: {report['latency'] * 1000:.1f}ms, {report['bytes_written']} bytes, "
+            f"{report['homes_written']} homes written, {report['homes_skipped']} skipped as clean"
+        )
+
+    print(f"Autosave with {number_of_homes} homes:")
+    print_report("First save", auto_saver.save_now())
+
+    for smart_home_name, smart_home in random.sample(smart_homes, number_of_changed_homes):
+        smart_home.toggle_device(0)
+    print_report(f"After changing {number_of_changed_homes} homes", auto_saver.save_now())
+
+    print_report("With nothing changed", auto_saver.save_now())
+
+
+#benchmark_autosave()
@@ -1,4 +1,11 @@
+import sys
+
+
 class SmartDevice:
+
+    # devices keep only their own state in slots, everything shared lives on the class
+    __slots__ = ("_switched_on",)
+    type_code = None
     
     def __init__(self):
         self._switched_on = False
@@ -13,6 +20,9 @@ class SmartDevice:
     
     def toggle_switch(self):
         self.switched_on = not self.switched_on
+
+    def is_default(self):
+        return not self._switched_on
     
     def __str__(self):
         state = "on" if self._switched_on else "off"
@@ -20,10 +30,15 @@ class SmartDevice:
 
 
 class SmartPlug(SmartDevice):
+
+    __slots__ = ("_consumption_rate",)
+    type_code = 0
+    min_consumption_rate = 0
+    max_consumption_rate = 150
     
     def __init__(self, consumption_rate=0):
         super().__init__()
-        if 0 <= consumption_rate <= 150:
+        if self.min_consumption_rate <= consumption_rate <= self.max_consumption_rate:
             self._consumption_rate = consumption_rate
         else:
             raise ValueError("Consumption rate must be between 0 and 150")
@@ -34,17 +49,25 @@ class SmartPlug(SmartDevice):
     
     @consumption_rate.setter
     def consumption_rate(self, value):
-        if 0 <= value <= 150:
+        if self.min_consumption_rate <= value <= self.max_consumption_rate:
             self._consumption_rate = value
         else:
             raise ValueError("Consumption rate must be between 0 and 150")
             
+    def is_default(self):
+        return not self._switched_on and self._consumption_rate == 0
+
     def __str__(self):
         state = super().__str__()
         return f"SmartPlug is {state} with a consumption rate of {self.consumption_rate}"
 
 
 class SmartTV(SmartDevice):
+
+    __slots__ = ("_channel",)
+    type_code = 1
+    min_channel = 1
+    max_channel = 734
     
     def __init__(self):
         super().__init__()
@@ -56,42 +79,54 @@ class SmartTV(SmartDevice):
     
     @channel.setter
     def channel(self, value):
-        if 1 <= value <= 734:
+        if self.min_channel <= value <= self.max_channel:
             self._channel = value
         else:
             raise ValueError("Channel number must be between 1 and 734")
             
+    def is_default(self):
+        return not self._switched_on and self._channel == 1
+
     def __str__(self):
         state = super().__str__()
         return f"SmartTV is {state}, channel number {self._channel}"
 
 
 class SmartWashingMachine(SmartDevice):
-    
-    valid_wash_modes = {
-        "Daily wash",
-        "Quick wash",
-        "Eco",
-    }
+
+    # each machine stores an index into wash_modes instead of its own string
+    __slots__ = ("_wash_mode_code",)
+    type_code = 2
+    wash_modes = ("Daily wash", "Quick wash", "Eco")
+    wash_mode_codes = {mode: code for code, mode in enumerate(wash_modes)}
+    valid_wash_modes = frozenset(wash_modes)
 
     def __init__(self):
         super().__init__()
-        self._wash_mode = "Daily wash"
+        self._wash_mode_code = 0
 
     @property
     def wash_mode(self):
-        return self._wash_mode
+        return self.wash_modes[self._wash_mode_code]
+
+    @property
+    def wash_mode_code(self):
+        return self._wash_mode_code
     
     @wash_mode.setter
     def wash_mode(self, value):
-        if value.capitalize() in self.valid_wash_modes:
-            self._wash_mode = value.capitalize()
+        code = self.wash_mode_codes.get(value.capitalize())
+        if code is not None:
+            self._wash_mode_code = code
         else:
             output = ""
-            for mode in self.valid_wash_modes:
+            for mode in self.wash_modes:
                 output += f"'{mode}', "
             raise ValueError(f"Wash mode must be one of: {output}")
 
+    def is_default(self):
+        return not self._switched_on and self._wash_mode_code == 0
+
     def __str__(self):
         state = super().__str__()
         return f"SmartWashingMachine is {state} with wash mode: {self.wash_mode}"
@@ -102,11 +137,25 @@ class SmartHome:
     def __init__(self, max_items=5):
         self._devices = []
         self._max_items = max_items
+        self._version = 0
+        self.listeners = []
+
+        # power budget: _current_power is the running total of switched on SmartPlug draw,
+        # so checking an action against the budget does not walk the devices
+        self._power_budget = None
+        self._current_power = 0
+        self.power_policy = "reject"
+        self.power_guard = None
+        self._device_priorities = {}
     
     @property
     def devices(self):
         return self._devices
     
+    @property
+    def version(self):
+        return self._version
+
     @property
     def max_items(self):
         return self._max_items
@@ -114,21 +163,125 @@ class SmartHome:
     @max_items.setter
     def max_items(self, value: int):
         self._max_items = value
+        self.notify("max_items", None, None)
+
+    @property
+    def current_power(self):
+        return self._current_power
+
+    @property
+    def power_budget(self):
+        return self._power_budget
+
+    @power_budget.setter
+    def power_budget(self, value):
+        if value is not None and value < 0:
+            raise ValueError("Power budget can't be negative")
+        old_budget = self._power_budget
+        self._power_budget = value
+        try:
+            self.ensure_power(0)
+        except ValueError:
+            self._power_budget = old_budget
+            raise
+
+    def device_power(self, device):
+        if isinstance(device, SmartPlug) and device.switched_on:
+            return device.consumption_rate
+        return 0
+
+    def recalculate_power(self):
+        # only needed if devices were changed directly instead of through the SmartHome
+        self._current_power = sum(self.device_power(device) for device in self.devices)
+        return self._current_power
+
+    def set_device_priority(self, index, priority):
+        self._device_priorities[self.get_device(index)] = priority
+
+    def get_device_priority(self, index):
+        return self._device_priorities.get(self.get_device(index), 0)
+
+    def ensure_power(self, extra_power, keep=None):
+        # raises ValueError if extra_power more watts would go over the budget, with the
+        # "shed" policy lower priority plugs than keep are switched off first to make room
+        if extra_power > 0 and self.power_guard:
+            self.power_guard(self, extra_power)
+
+        if self._power_budget is None or self._current_power + extra_power <= self._power_budget:
+            return
+
+        if self.power_policy == "shed":
+            keep_priority = self._device_priorities.get(keep, 0)
+            candidates = [
+                (self._device_priorities.get(device, 0), i, device)
+                for i, device in enumerate(self.devices)
+                if device is not keep and self.device_power(device) > 0
+                and self._device_priorities.get(device, 0) < keep_priority
+            ]
+            candidates.sort(key=lambda candidate: candidate[:2])
+
+            shed_power = 0
+            to_shed = []
+            for priority, i, device in candidates:
+                if self._current_power - shed_power + extra_power <= self._power_budget:
+                    break
+                to_shed.append((i, device))
+                shed_power += device.consumption_rate
+
+            if self._current_power - shed_power + extra_power <= self._power_budget:
+                for i, device in to_shed:
+                    device.switched_on = False
+                    self._current_power -= device.consumption_rate
+                    self.notify("update", i, device)
+                return
+
+        raise ValueError(
+            f"Power budget of {self._power_budget}W exceeded: "
+            f"{self._current_power}W in use, {extra_power}W more requested"
+        )
+
+    def notify(self, event, index, device):
+        # every mutation bumps the version, listeners are called as listener(smart_home, event, index, device)
+        self._version += 1
+        for listener in self.listeners:
+            listener(self, event, index, device)
 
     def add_device(self, device):
         if len(self.devices) >= self.max_items:
             raise ValueError(f"Maximum number of devices reached for this SmartHome: {self.max_items}")
         if isinstance(device, SmartDevice):
+            self.ensure_power(self.device_power(device), keep=device)
             self.devices.append(device)
+            self._current_power += self.device_power(device)
+            self.notify("add", len(self.devices) - 1, device)
         else:
             raise ValueError("Must be an object that inherits SmartDevice")
     
     def remove_device(self, index):
         if 0 <= index < len(self.devices):
+            device = self.devices[index]
             del self.devices[index]
+            self._current_power -= self.device_power(device)
+            self._device_priorities.pop(device, None)
+            self.notify("remove", index, device)
         else:
             raise IndexError("Invalid index! Out of range")
 
+    def replace_devices(self, devices, max_items=None):
+        # swaps in a whole new device list at once, e.g. when a delta from another instance is applied
+        if max_items is None:
+            max_items = self._max_items
+        if len(devices) > max_items:
+            raise ValueError(f"Maximum number of devices reached for this SmartHome: {max_items}")
+        for device in devices:
+            if not isinstance(device, SmartDevice):
+                raise ValueError("Must be an object that inherits SmartDevice")
+        self._max_items = max_items
+        self._devices[:] = devices
+        self._device_priorities = {}
+        self.recalculate_power()
+        self.notify("replace", None, None)
+
     def get_device(self, index):
         if 0 <= index < len(self.devices):
             return self.devices[index]
@@ -137,36 +290,104 @@ class SmartHome:
         
     def toggle_device(self, index):
         device = self.get_device(index)
+        if isinstance(device, SmartPlug) and not device.switched_on:
+            self.ensure_power(device.consumption_rate, keep=device)
+        self._current_power -= self.device_power(device)
         device.toggle_switch()
+        self._current_power += self.device_power(device)
+        self.notify("update", index, device)
         
     def switch_all_on(self):
+        extra_power = 0
+        for device in self.devices:
+            if isinstance(device, SmartPlug) and not device.switched_on:
+                extra_power += device.consumption_rate
+
+        if self._power_budget is not None and self.power_policy == "shed":
+            # switch plugs on by priority for as long as they fit, everything else goes on
+            self.switch_all_on_within_budget()
+            return
+
+        self.ensure_power(extra_power)
         for device in self.devices:
             device.switched_on = True
+        self._current_power += extra_power
+        self.notify("update_all", None, None)
+
+    def switch_all_on_within_budget(self):
+        plugs = []
+        for device in self.devices:
+            if isinstance(device, SmartPlug):
+                if not device.switched_on:
+                    plugs.append(device)
+            else:
+                device.switched_on = True
+        plugs.sort(key=lambda device: -self._device_priorities.get(device, 0))
+
+        # the fleet guard only hears about this home's new draw with the notify at the end,
+        # so every plug is checked together with what the plugs before it were granted
+        granted_power = 0
+        for device in plugs:
+            if self._current_power + device.consumption_rate <= self._power_budget:
+                if self.power_guard and device.consumption_rate:
+                    try:
+                        self.power_guard(self, granted_power + device.consumption_rate)
+                    except ValueError:
+                        continue
+                device.switched_on = True
+                self._current_power += device.consumption_rate
+                granted_power += device.consumption_rate
+        self.notify("update_all", None, None)
     
     def switch_all_off(self):
         for device in self.devices:
             device.switched_on = False
+        self._current_power = 0
+        self.notify("update_all", None, None)
 
     def update_option(self, index, value):
         if index < 0 or index >= len(self.devices):
             raise IndexError("Invalid index! Out of range")
         
         device = self.get_device(index)
+        self.validate_option(device, value)
         
+        if isinstance(device, SmartPlug):
+            old_power = self.device_power(device)
+            if device.switched_on:
+                self.ensure_power(value - old_power, keep=device)
+            device.consumption_rate = value
+            self._current_power += self.device_power(device) - old_power
+        
+        elif isinstance(device, SmartTV):
+            device.channel = value
+
+        elif isinstance(device, SmartWashingMachine):
+            device.wash_mode = value
+
+        self.notify("update", index, device)
+
+    @staticmethod
+    def validate_option(device, value):
+        # the checks update_option makes before changing anything, also usable ahead of time
         if isinstance(device, SmartPlug):
             if type(value) != int:
                 raise TypeError("Consumption rate must be an integer")
-            device.consumption_rate = value
+            if not SmartPlug.min_consumption_rate <= value <= SmartPlug.max_consumption_rate:
+                raise ValueError("Consumption rate must be between 0 and 150")
         
         elif isinstance(device, SmartTV):
             if type(value) != int:
                 raise TypeError("Channel number must be an integer")
-            device.channel = value
+            if not SmartTV.min_channel <= value <= SmartTV.max_channel:
+                raise ValueError("Channel number must be between 1 and 734")
 
         elif isinstance(device, SmartWashingMachine):
             if type(value) != str:
                 raise TypeError("Wash mode must be a string")
-            device.wash_mode = value
+            if value.capitalize() not in SmartWashingMachine.wash_mode_codes:
+                output = "".join(f"'{mode}', " for mode in SmartWashingMachine.wash_modes)
+                raise ValueError(f"Wash mode must be one of: {output}")
         else:
             raise ValueError("Wrong device type or update option")
 
@@ -208,11 +429,169 @@ class SmartHome:
 
 
     def __str__(self):
-        output = f"SmartHome with {len(self.devices)} device(s): \n"
-        for i in range(len(self.devices)):
-            output += f"{i+1}- {self.devices[i]} \n"
-            i += 1
-        return output
+        # joined in one go, reports.write_report streams large homes and fleets instead
+        lines = [f"SmartHome with {len(self.devices)} device(s): \n"]
+        for i, device in enumerate(self.devices):
+            lines.append(f"{i+1}- {device} \n")
+        return "".join(lines)
+
+
+def create_default_smart_home():
+    # what a new home starts with in the apps and in trace replays
+    smart_home = SmartHome()
+    smart_home.add_device(SmartTV())
+    smart_home.add_device(SmartWashingMachine())
+    smart_home.add_device(SmartPlug())
+    return smart_home
+
+
+class ReadOnlyDefault:
+
+    # mixed into a device class for the shared stand-in SparseDevices returns for placeholders
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Devices at their defaults are read-only here, change them through the SmartHome")
+
+
+read_only_defaults = {}
+
+
+def read_only_default(device_class):
+    # one shared read-only default device per class, with the class's own name
+    device = read_only_defaults.get(device_class)
+    if device is None:
+        read_only_class = type(device_class.__name__, (ReadOnlyDefault, device_class), {"__slots__": ()})
+        device = device_class()
+        device.__class__ = read_only_class
+        read_only_defaults[device_class] = device
+    return device
+
+
+class SparseDevices:
+
+    # list-like view over SparseSmartHome slots, reading only ever shows placeholders as a
+    # shared read-only default, so drawing or counting a home doesn't create devices
+    __slots__ = ("_smart_home",)
+
+    def __init__(self, smart_home):
+        self._smart_home = smart_home
+
+    def __len__(self):
+        return len(self._smart_home._devices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("list index out of range")
+        slot = self._smart_home._devices[index]
+        return read_only_default(slot) if isinstance(slot, type) else slot
+
+    def __iter__(self):
+        for slot in self._smart_home._devices:
+            yield read_only_default(slot) if isinstance(slot, type) else slot
+
+    def __delitem__(self, index):
+        del self._smart_home._devices[index]
+
+    def __contains__(self, device):
+        return any(slot is device for slot in self._smart_home._devices)
+
+    def append(self, device):
+        self._smart_home._devices.append(device)
+
+    def index(self, device):
+        for i, slot in enumerate(self._smart_home._devices):
+            if slot is device:
+                return i
+        raise ValueError("device is not in this SmartHome")
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class SparseSmartHome(SmartHome):
+
+    # devices still at their defaults are kept as their class instead of an object, they are
+    # only created when handed out by get_device or changed, and compact() turns them back
+    @property
+    def devices(self):
+        # a fresh view each time, so an idle home carries nothing extra
+        return SparseDevices(self)
+
+    @property
+    def slots(self):
+        return self._devices
+
+    def materialize(self, index):
+        slot = self._devices[index]
+        if isinstance(slot, type):
+            slot = slot()
+            self._devices[index] = slot
+        return slot
+
+    def get_device(self, index):
+        # the caller may change what it gets, so it has to be the home's own device
+        if 0 <= index < len(self._devices):
+            return self.materialize(index)
+        else:
+            raise IndexError("Invalid index! Out of range")
+
+    def add_default_device(self, device_class):
+        if len(self._devices) >= self.max_items:
+            raise ValueError(f"Maximum number of devices reached for this SmartHome: {self.max_items}")
+        if not (isinstance(device_class, type) and issubclass(device_class, SmartDevice)):
+            raise ValueError("Must be a class that inherits SmartDevice")
+
+        self._devices.append(device_class)
+        self.notify("add", len(self._devices) - 1, read_only_default(device_class))
+
+    def switch_all_on(self):
+        # every device leaves its defaults, so they all have to be real devices first
+        for i in range(len(self._devices)):
+            self.materialize(i)
+        super().switch_all_on()
+
+    def switch_all_off(self):
+        # placeholders are already off, so only real devices are touched
+        for slot in self._devices:
+            if not isinstance(slot, type):
+                slot.switched_on = False
+        self._current_power = 0
+        self.notify("update_all", None, None)
+
+    def is_default_slot(self, index):
+        slot = self._devices[index]
+        return isinstance(slot, type) or slot.is_default()
+
+    def compact(self):
+        # a device at its defaults is only turned back into a placeholder when nothing else
+        # holds it (an open view, a queued command, a priority), so changes made through a
+        # device handed out earlier still reach the home
+        compacted = 0
+        for i in range(len(self._devices)):
+            slot = self._devices[i]
+            if isinstance(slot, type) or not slot.is_default():
+                continue
+            # the home's list, slot and getrefcount's own argument
+            if sys.getrefcount(slot) > 3:
+                continue
+            self._devices[i] = type(slot)
+            compacted += 1
+        return compacted
+
+    def count_defaults(self):
+        return sum(1 for slot in self._devices if isinstance(slot, type))
+
+    def default_bitmap(self):
+        bitmap = 0
+        for i, slot in enumerate(self._devices):
+            if isinstance(slot, type):
+                bitmap |= 1 << i
+        return bitmap
 
 
 def test_smart_plug():
@@ -391,6 +770,76 @@ def test_smart_home():
     print()
 
 
+def benchmark_device_memory(number_of_devices=1000000):
+    import tracemalloc
+
+    # the layout before slots: a per-instance __dict__ and a wash mode string per machine
+    class DictDevice:
+        def __init__(self, value):
+            self._switched_on = False
+            self._value = value
+
+    device_types = [
+        ("SmartPlug", SmartPlug, lambda: DictDevice(0)),
+        ("SmartTV", SmartTV, lambda: DictDevice(1)),
+        ("SmartWashingMachine", SmartWashingMachine, lambda: DictDevice("Daily wash".lower().capitalize())),
+    ]
+
+    print(f"Memory per device with {number_of_devices} devices:")
+    for device_type, device_class, create_dict_device in device_types:
+        for layout, create_device in (("dict", create_dict_device), ("slots", device_class)):
+            tracemalloc.start()
+            devices = [create_device() for i in range(number_of_devices)]
+            memory_used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del devices
+            print(f"{device_type} ({layout}): {memory_used / number_of_devices:.1f} bytes")
+
+
+def benchmark_sparse_homes(number_of_homes=200000, devices_per_home=5):
+    import random
+    import tracemalloc
+    from savefile import smart_home_to_csv_line
+
+    device_classes = [SmartPlug, SmartTV, SmartWashingMachine]
+    print(f"{number_of_homes} homes with {devices_per_home} devices each:")
+
+    for default_fraction in (0.0, 0.5, 0.9):
+        for sparse in (False, True):
+            random.seed(1)
+            tracemalloc.start()
+            smart_homes = []
+            for i in range(number_of_homes):
+                smart_home = SparseSmartHome(devices_per_home) if sparse else SmartHome(devices_per_home)
+                for j in range(devices_per_home):
+                    device_class = device_classes[j % 3]
+                    if random.random() < default_fraction:
+                        if sparse:
+                            smart_home.add_default_device(device_class)
+                        else:
+                            smart_home.add_device(device_class())
+                    else:
+                        device = device_class()
+                        device.switched_on = True
+                        smart_home.add_device(device)
+                smart_homes.append(smart_home)
+            memory_used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            save_size = sum(
+                len(smart_home_to_csv_line(f"Smart Home {i+1}", smart_home, sparse=sparse))
+                for i, smart_home in enumerate(smart_homes)
+            )
+            layout = "sparse" if sparse else "dense"
+            print(
+                f"{default_fraction:.0%} at defaults, {layout}: {memory_used / 1024 / 1024:.1f}MiB in memory, "
+                f"{save_size / 1024 / 1024:.1f}MiB saved"
+            )
+            del smart_homes
+
+
 #test_smart_plug()
 #test_custom_device()
-#test_smart_home()
\ No newline at end of file
+#test_smart_home()
+#benchmark_device_memory()
+#benchmark_sparse_homes()
\ No newline at end of file
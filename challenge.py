@@ -1,11 +1,20 @@
-from tkinter import Tk, Frame, Label, Button, Toplevel, IntVar
+import os
+import queue
+import sys
+from tkinter import Tk, Frame, Label, Button, Toplevel, Menu, Scrollbar
+from tkinter import ttk, messagebox
 from tkinter.filedialog import askopenfilename, asksaveasfilename
-from backend import SmartPlug, SmartTV, SmartWashingMachine, SmartHome
+from backend import SparseSmartHome
 from frontend import SmartHomeApp
+from savefile import iter_csv, iter_csv_parallel, save_csv, smart_home_id, compression_for
+from storage import SQLiteStore
+from autosave import AutoSaver
+from workload import TraceRecorder
+from snapshot import read_snapshot, write_snapshot, source_signature
 
 class SmartHomesApp:
 
-    def __init__(self):
+    def __init__(self, renderer="widgets"):
         self.win = Tk()
         self.win.title("Smart Home Manager")
 
@@ -34,13 +43,189 @@ class SmartHomesApp:
         self.smart_homes_dict = {}
         self.widgets_list = []
 
+        # smart_homes_dict holds the SmartHome models, views holds at most one open SmartHomeApp per home
+        self.views = {}
+
+        # when a database is open only the current page of homes is kept in smart_homes_dict
+        self.store = None
+        self.page_offset = 0
+        self.page_size = 10
+
+        # background autosave into the file last chosen with Save State, savers that were
+        # stopped without waiting may still be doing their final save
+        self.auto_saver = None
+        self.stopped_auto_savers = []
+        self.autosave_interval = 30
+        self.autosave_errors = queue.Queue()
+
+        # saves at least this big are parsed by a pool of worker processes
+        self.parallel_load_threshold = 64 * 1024 * 1024
+        self.parallel_load_workers = os.cpu_count()
+
+        # used when the save file name ends in .gz or .xz
+        self.save_compression_level = None
+
+        # keep devices that are at their defaults as placeholders in memory and in saves
+        self.sparse_devices = False
+
+        # every operation made here and in the open views is logged while a trace is recorded
+        self.recorder = None
+
+        # the last loaded or saved file is restored from its snapshot on the next start
+        self.snapshots = True
+        self.last_session_file_name = os.path.join(os.path.expanduser("~"), ".smart_homes_last_save")
+        self.win.protocol("WM_DELETE_WINDOW", self.close)
+
+        # "widgets" draws a label and two buttons per home, "tree" draws one Treeview for all homes
+        self.renderer = renderer
+        self.smart_home_tree = None
+        self.context_menu = None
+        self.context_menu_name = None
+
     def run(self):
         self.create_widgets()
+        self.win.after(500, self.check_autosave_errors)
         self.win.mainloop()
 
+    def close(self):
+        try:
+            self.close_all_views()
+            if self.auto_saver:
+                # the final save makes the save file match the homes, so the snapshot can follow it
+                file_name = self.auto_saver.file_name
+                report = self.stop_autosave(wait=True)
+                if report["error"]:
+                    messagebox.showerror("Save State", f"The final save failed: {report['error']}", parent=self.win)
+                elif report["complete"] and self.snapshots and not self.store:
+                    self.write_snapshot(file_name)
+        finally:
+            for auto_saver in self.stopped_auto_savers:
+                auto_saver.stop()
+            if self.store:
+                self.store.close()
+            if self.recorder:
+                self.recorder.close()
+            self.win.destroy()
+
+    def stop_autosave(self, wait=False):
+        # called before smart_homes_dict is replaced or a database is opened. The final save
+        # gets the homes as they are now and runs on the autosave thread, so the file keeps the
+        # fleet it was chosen for and the Tk thread only waits for it if wait is set
+        if self.auto_saver is None:
+            return None
+        auto_saver = self.auto_saver
+        self.auto_saver = None
+        smart_homes = self.list_smart_homes()
+        auto_saver.get_smart_homes = lambda: smart_homes
+        report = auto_saver.stop(wait=wait)
+        if not wait:
+            self.stopped_auto_savers = [
+                stopped for stopped in self.stopped_auto_savers if stopped.thread and stopped.thread.is_alive()
+            ]
+            self.stopped_auto_savers.append(auto_saver)
+        return report
+
+    def on_autosave_report(self, report):
+        # called on the autosave thread, the Tk thread shows the errors in check_autosave_errors
+        if report["error"]:
+            self.autosave_errors.put(report["error"])
+
+    def check_autosave_errors(self):
+        while not self.autosave_errors.empty():
+            error = self.autosave_errors.get_nowait()
+            messagebox.showerror("Save State", f"Saving failed: {error}", parent=self.win)
+        self.win.after(500, self.check_autosave_errors)
+
+    def start_recording(self, file_name):
+        if self.recorder:
+            self.recorder.close()
+        self.recorder = TraceRecorder(file_name)
+        for smart_home_name, view in self.views.items():
+            view.recorder = self.recorder
+            view.smart_home_name = smart_home_name
+
+    def record(self, operation, smart_home_name=None, *arguments):
+        if self.recorder:
+            self.recorder.record(operation, smart_home_name, *arguments)
+
     def create_widgets(self):
+        if self.renderer == "tree":
+            self.create_tree_widgets()
+            return
+
         self.delete_all_smart_home_widgets()
+        self.create_control_widgets()
+        
+        count_smart_homes = len(self.smart_homes_dict)
+        smart_home_names = list(self.smart_homes_dict.keys())
 
+        for i in range(count_smart_homes):
+            smart_home_name = smart_home_names[i]
+            number_of_devices, number_of_devices_currently_on = self.describe_smart_home(smart_home_name)
+            
+            smart_home_label = Label(
+                self.main_frame,
+                text=f"{smart_home_name}: {number_of_devices} devices, {number_of_devices_currently_on} switched on",
+                font=("Arial", 11),
+            )
+            smart_home_label.grid(
+                row=i+3,
+                column=0,
+                columnspan=2,
+                pady=5,
+            )
+            self.widgets_list.append(smart_home_label)
+
+            modify_smart_home_button = Button(
+                self.main_frame,
+                text="Modify",
+                font=("Arial", 11),
+                bg="white",
+                bd=1,
+                command=lambda index=smart_home_name :self.modify_smart_home(index)
+            )
+            modify_smart_home_button.grid(
+                row=i+3,
+                column=2,
+                sticky="ew",
+                padx=5,
+                pady=5,
+            )
+            self.widgets_list.append(modify_smart_home_button)
+
+            delete_smart_home_button = Button(
+                self.main_frame,
+                text="Delete",
+                font=("Arial", 11),
+                bg="white",
+                bd=1,
+                command=lambda index=smart_home_name :self.remove_smart_home(index)
+            )
+            delete_smart_home_button.grid(
+                row=i+3,
+                column=3,
+                sticky="ew",
+                padx=5,
+                pady=5,
+            )
+            self.widgets_list.append(delete_smart_home_button)
+
+        if self.store:
+            self.create_page_widgets(count_smart_homes + 3)
+
+        self.win.geometry(f"{self.window_width}x{(self.window_height // 2) + (count_smart_homes * 38)}")
+
+    def describe_smart_home(self, smart_home_name):
+        devices = self.smart_homes_dict[smart_home_name].devices
+
+        number_of_devices_currently_on = 0
+        for device in devices:
+            if device.switched_on:
+                number_of_devices_currently_on += 1
+
+        return len(devices), number_of_devices_currently_on
+
+    def create_control_widgets(self):
         title_label = Label(
             self.main_frame,
             text="Smart Home Manager",
@@ -98,113 +283,265 @@ class SmartHomesApp:
         add_button.grid(
             row=2,
             column=0,
-            columnspan=4,
+            columnspan=2,
             sticky="ew",
             padx=5,
             pady=5
         )
-        
-        count_smart_homes = len(self.smart_homes_dict)
-        smart_home_names = list(self.smart_homes_dict.keys())
 
-        for i in range(count_smart_homes):
-            smart_home_name = smart_home_names[i]
-            
-            smart_home_app_object = self.smart_homes_dict[smart_home_name][0]
-            devices = smart_home_app_object.smart_home.devices
-            number_of_devices = len(smart_home_app_object.smart_home.devices)
-            
-            number_of_devices_currently_on = 0
-            for device in devices:
-                if device.switched_on:
-                    number_of_devices_currently_on += 1
-            
-            smart_home_label = Label(
-                self.main_frame,
-                text=f"{smart_home_name}: {number_of_devices} devices, {number_of_devices_currently_on} switched on",
-                font=("Arial", 11),
-            )
-            smart_home_label.grid(
-                row=i+3,
-                column=0,
-                columnspan=2,
-                pady=5,
-            )
-            self.widgets_list.append(smart_home_label)
+        open_database_button = Button(
+            self.main_frame,
+            text="Open Database",
+            font=("Arial", 11),
+            bg="white",
+            bd=1,
+            command=self.open_database
+        )
+        open_database_button.grid(
+            row=2,
+            column=2,
+            columnspan=2,
+            sticky="ew",
+            padx=5,
+            pady=5
+        )
 
-            modify_smart_home_button = Button(
+    def create_tree_widgets(self):
+        # the widgets are built once, later calls only refill the rows and the page buttons
+        if self.smart_home_tree is None:
+            self.create_control_widgets()
+
+            self.smart_home_tree = ttk.Treeview(
                 self.main_frame,
-                text="Modify",
-                font=("Arial", 11),
-                bg="white",
-                bd=1,
-                command=lambda index=smart_home_name :self.modify_smart_home(index)
+                columns=("name", "devices", "switched_on"),
+                show="headings",
+                selectmode="browse",
+                height=10
             )
-            modify_smart_home_button.grid(
-                row=i+3,
-                column=2,
-                sticky="ew",
+            self.smart_home_tree.heading("name", text="Smart Home")
+            self.smart_home_tree.heading("devices", text="Devices")
+            self.smart_home_tree.heading("switched_on", text="Switched On")
+            self.smart_home_tree.grid(
+                row=3,
+                column=0,
+                columnspan=4,
+                sticky="nsew",
                 padx=5,
-                pady=5,
+                pady=5
             )
-            self.widgets_list.append(modify_smart_home_button)
 
-            delete_smart_home_button = Button(
-                self.main_frame,
-                text="Delete",
-                font=("Arial", 11),
-                bg="white",
-                bd=1,
-                command=lambda index=smart_home_name :self.remove_smart_home(index)
-            )
-            delete_smart_home_button.grid(
-                row=i+3,
-                column=3,
-                sticky="ew",
-                padx=5,
-                pady=5,
+            tree_scrollbar = Scrollbar(self.main_frame, command=self.smart_home_tree.yview)
+            tree_scrollbar.grid(row=3, column=4, sticky="ns")
+            self.smart_home_tree.configure(yscrollcommand=tree_scrollbar.set)
+
+            self.context_menu = Menu(self.win, tearoff=0)
+            self.context_menu.add_command(label="Modify", command=lambda: self.on_context_menu(self.modify_smart_home))
+            self.context_menu.add_command(label="Delete", command=lambda: self.on_context_menu(self.remove_smart_home))
+
+            self.smart_home_tree.bind("<Double-1>", self.on_smart_home_tree_event)
+            self.smart_home_tree.bind("<Button-3>", self.on_smart_home_tree_event)
+            self.smart_home_tree.bind("<Return>", self.on_smart_home_tree_event)
+
+            self.win.geometry(f"{self.window_width}x{self.window_height + 160}")
+
+        self.delete_all_smart_home_widgets()
+        self.smart_home_tree.delete(*self.smart_home_tree.get_children())
+        for smart_home_name in self.smart_homes_dict:
+            number_of_devices, number_of_devices_currently_on = self.describe_smart_home(smart_home_name)
+            self.smart_home_tree.insert(
+                "",
+                "end",
+                iid=smart_home_name,
+                values=(smart_home_name, number_of_devices, number_of_devices_currently_on)
             )
-            self.widgets_list.append(delete_smart_home_button)
 
-        self.win.geometry(f"{self.window_width}x{(self.window_height // 2) + (count_smart_homes * 38)}")
+        if self.store:
+            self.create_page_widgets(4)
+
+    def on_smart_home_tree_event(self, event):
+        # one handler for every row, the row is found by hit-testing the event position
+        if event.keysym == "Return":
+            row = self.smart_home_tree.focus()
+        else:
+            row = self.smart_home_tree.identify_row(event.y)
+        if not row:
+            return
+
+        self.smart_home_tree.selection_set(row)
+
+        if event.num == 3:
+            self.context_menu_name = row
+            self.context_menu.tk_popup(event.x_root, event.y_root)
+        else:
+            self.modify_smart_home(row)
+
+    def on_context_menu(self, action):
+        if self.context_menu_name is not None:
+            action(self.context_menu_name)
+            self.context_menu_name = None
+
+    def create_page_widgets(self, row):
+        count_stored_homes = self.store.count_homes()
+        last_shown = min(self.page_offset + self.page_size, count_stored_homes)
+
+        previous_page_button = Button(
+            self.main_frame,
+            text="Previous",
+            font=("Arial", 11),
+            bg="white",
+            bd=1,
+            command=lambda: self.change_page(-1)
+        )
+        previous_page_button.grid(
+            row=row,
+            column=0,
+            sticky="ew",
+            padx=5,
+            pady=5
+        )
+        self.widgets_list.append(previous_page_button)
+
+        page_label = Label(
+            self.main_frame,
+            text=f"{self.page_offset + 1 if count_stored_homes else 0}-{last_shown} of {count_stored_homes}",
+            font=("Arial", 11),
+        )
+        page_label.grid(
+            row=row,
+            column=1,
+            columnspan=2,
+            pady=5,
+        )
+        self.widgets_list.append(page_label)
+
+        next_page_button = Button(
+            self.main_frame,
+            text="Next",
+            font=("Arial", 11),
+            bg="white",
+            bd=1,
+            command=lambda: self.change_page(1)
+        )
+        next_page_button.grid(
+            row=row,
+            column=3,
+            sticky="ew",
+            padx=5,
+            pady=5
+        )
+        self.widgets_list.append(next_page_button)
+
+    def change_page(self, direction):
+        new_offset = self.page_offset + direction * self.page_size
+        if 0 <= new_offset < self.store.count_homes():
+            self.page_offset = new_offset
+            self.load_page()
+            self.create_widgets()
+
+    def load_page(self):
+        self.close_all_views()
+        for smart_home_name in list(self.store.attached):
+            self.store.detach(smart_home_name)
+
+        self.smart_homes_dict = {}
+        for smart_home_name, smart_home in self.store.page_homes(self.page_offset, self.page_size):
+            self.store.attach(smart_home_name, smart_home)
+            self.smart_homes_dict[smart_home_name] = smart_home
+
+    def open_database(self):
+        file_name = asksaveasfilename(
+            defaultextension=".db",
+            filetypes=[("SQLite databases", "*.db")],
+            confirmoverwrite=False
+        )
+        if not file_name:
+            return
+
+        # autosave only ever covers a fleet held in memory, never a page of the database
+        self.stop_autosave()
+        if self.store:
+            self.store.close()
+        self.store = SQLiteStore(file_name)
+        self.page_offset = 0
+
+        max_id_seen = 0
+        for smart_home_name in self.store.home_names():
+            max_id_seen = max(max_id_seen, smart_home_id(smart_home_name))
+        self.next_smart_home_id = max_id_seen + 1
+
+        self.load_page()
+        self.create_widgets()
+
+    def iter_smart_homes(self):
+        if self.store:
+            return self.store.iter_homes()
+        return iter(list(self.smart_homes_dict.items()))
 
     def add_smart_home(self):
-        add_win = Toplevel(self.win)
-        smart_home_app_object = SmartHomeApp(add_win)
-        
-        smart_home_app_object.update_parent_win = self.create_widgets
-        smart_home_app_object.create_widgets()
+        smart_home = SmartHomeApp.create_default_smart_home()
         
         smart_home_name = f"Smart Home {self.next_smart_home_id}"
         self.next_smart_home_id += 1
+        self.record("add_home", smart_home_name)
         
+        if self.store:
+            self.store.save_home(smart_home_name, smart_home)
+            self.store.attach(smart_home_name, smart_home)
+
         # create new dictionary entry
-        self.smart_homes_dict[smart_home_name] = [smart_home_app_object, []]
+        self.smart_homes_dict[smart_home_name] = smart_home
+        self.open_view(smart_home_name)
         self.create_widgets()
 
     def remove_smart_home(self, smart_home_name):
+        self.record("remove_home", smart_home_name)
+        self.close_view(smart_home_name)
         del self.smart_homes_dict[smart_home_name]
+        if self.store:
+            self.store.delete_home(smart_home_name)
         self.create_widgets()
 
     def modify_smart_home(self, smart_home_name):
-        modify_win = Toplevel(self.win)
+        self.open_view(smart_home_name)
+
+    def open_view(self, smart_home_name):
+        # an already open window is brought to the front instead of building a second one
+        view = self.views.get(smart_home_name)
+        if view is not None and view.win.winfo_exists():
+            view.win.deiconify()
+            view.win.lift()
+            view.win.focus_force()
+            return view
+
+        view_win = Toplevel(self.win)
         x_position, y_position = SmartHomeApp.calc_centre_of_screen(self)
-        modify_win.geometry(f"{self.window_width}x{self.window_height}+{x_position}+{y_position}")
+        view_win.geometry(f"{self.window_width}x{self.window_height}+{x_position}+{y_position}")
 
-        # temporarily store the SmartHome from the current SmartHomeApp
-        smart_home_app_object = self.smart_homes_dict[smart_home_name][0]
-        temp_smart_home = smart_home_app_object.smart_home
-        
-        # create a new SmartHomeApp with the same smart home data
-        new_app = SmartHomeApp(modify_win)
-        new_app.smart_home = temp_smart_home 
-        
-        # update the parent window
-        new_app.update_parent_win = self.create_widgets
-        new_app.create_widgets()
-        
-        # update the dictionary so it points to the new SmartHomeApp object
-        self.smart_homes_dict[smart_home_name][0] = new_app
+        view = SmartHomeApp(view_win, renderer=self.renderer, smart_home=self.smart_homes_dict[smart_home_name])
+        view.win.title(smart_home_name)
+        view.update_parent_win = self.create_widgets
+        view.recorder = self.recorder
+        view.smart_home_name = smart_home_name
+        view.create_widgets()
+
+        view_win.protocol("WM_DELETE_WINDOW", lambda: self.close_view(smart_home_name))
+        self.views[smart_home_name] = view
+        return view
+
+    def close_view(self, smart_home_name):
+        view = self.views.pop(smart_home_name, None)
+        if view is not None:
+            view.update_parent_win = None
+            view.win.destroy()
+
+            # nothing holds on to the devices any more, so defaults can go back to placeholders
+            smart_home = self.smart_homes_dict.get(smart_home_name)
+            if isinstance(smart_home, SparseSmartHome):
+                smart_home.compact()
+
+    def close_all_views(self):
+        for smart_home_name in list(self.views):
+            self.close_view(smart_home_name)
     
     def delete_all_smart_home_widgets(self):
         for widget in self.widgets_list:
@@ -212,92 +549,168 @@ class SmartHomesApp:
         self.widgets_list = []
 
     def load_save(self):
-        file_name = askopenfilename(filetypes=[("CSV files only", "*.csv")])
+        file_name = askopenfilename(filetypes=[("CSV files", "*.csv *.csv.gz *.csv.xz")])
         if not file_name:
             return
-        
-        self.smart_homes_dict = {}
+        self.load_file(file_name)
 
-        file = open(file_name, "r")
+    def load_file(self, file_name):
+        self.record("load_save", None, file_name)
+        signature = source_signature(file_name)
+        self.stop_autosave()
+        self.close_all_views()
+        self.smart_homes_dict = {}
         max_id_seen = 0
-        new_win = Toplevel()
-        new_win.withdraw()
 
-        for line in file:
-            smart_home_data = line.strip().split(",")
-            smart_home_name = smart_home_data[0]
-            max_items = int(smart_home_data[1])
-            
-            smart_home = SmartHome(max_items)
-            smart_home_app_object = SmartHomeApp(new_win)
-            smart_home_app_object.smart_home = smart_home
-            
-            smart_home_id = int(smart_home_name.split()[-1])
-            if smart_home_id > max_id_seen:
-                max_id_seen = smart_home_id
-            
-            i = 2
-            while i + 2 < len(smart_home_data):
-                device_type = smart_home_data[i]
-                if smart_home_data[i+1] == "True":
-                    device_state = True
-                elif smart_home_data[i+1] == "False":
-                    device_state = False
-                
-                device_value = smart_home_data[i+2]
-                if device_type == "SmartPlug":
-                    device = SmartPlug(int(device_value))
-                elif device_type == "SmartTV":
-                    device = SmartTV()
-                    device.channel = int(device_value)
-                elif device_type == "SmartWashingMachine":
-                    device = SmartWashingMachine()
-                    device.wash_mode = device_value
-                
-                device.switched_on = device_state
-                smart_home.add_device(device)
-                i += 3
-            
-            self.smart_homes_dict[smart_home_name] = [smart_home_app_object,[]]
-            
-        smart_home_app_object.update_parent_win = self.create_widgets
+        # compressed saves can't be split into byte ranges, they are always streamed
+        if compression_for(file_name) is None and os.path.getsize(file_name) >= self.parallel_load_threshold:
+            csv_homes = iter_csv_parallel(file_name, self.parallel_load_workers, self.sparse_devices)
+        else:
+            csv_homes = iter_csv(file_name, sparse=self.sparse_devices)
+
+        if self.store:
+            # import straight into the database in one transaction, then show the first page
+            def smart_homes():
+                nonlocal max_id_seen
+                for smart_home_name, smart_home in csv_homes:
+                    max_id_seen = max(max_id_seen, smart_home_id(smart_home_name))
+                    yield smart_home_name, smart_home
+
+            # the old homes are only gone once the whole save has been imported, a bad save
+            # leaves the database as it was
+            try:
+                with self.store.transaction():
+                    self.store.clear()
+                    self.store.save_homes(smart_homes())
+            except Exception:
+                self.load_page()
+                self.create_widgets()
+                raise
+            self.page_offset = 0
+            self.load_page()
+        else:
+            for smart_home_name, smart_home in csv_homes:
+                max_id_seen = max(max_id_seen, smart_home_id(smart_home_name))
+                self.smart_homes_dict[smart_home_name] = smart_home
+
         self.next_smart_home_id = max_id_seen + 1
+        if self.snapshots and not self.store and source_signature(file_name) == signature:
+            self.write_snapshot(file_name)
         self.create_widgets()
-        file.close()
+
+    def write_snapshot(self, file_name):
+        # only called while smart_homes_dict holds exactly what file_name does, a snapshot
+        # that can't be written only costs the next start a CSV load
+        try:
+            write_snapshot(file_name, self.smart_homes_dict, self.next_smart_home_id)
+            with open(self.last_session_file_name, "w") as file:
+                file.write(file_name)
+        except (OSError, ValueError):
+            pass
+
+    def restore_last_session(self):
+        # one bulk read of the snapshot if it still matches the save, the save itself otherwise
+        try:
+            with open(self.last_session_file_name) as file:
+                file_name = file.read().strip()
+        except OSError:
+            return False
+        if not file_name or not os.path.exists(file_name):
+            return False
+
+        state = read_snapshot(file_name) if self.snapshots else None
+        if state is None:
+            # main() calls this on every start, a save that can't be loaded any more (corrupt,
+            # truncated, unreadable, any compression error) must not keep the app from starting
+            try:
+                self.load_file(file_name)
+            except Exception:
+                self.smart_homes_dict = {}
+                self.next_smart_home_id = 1
+                return False
+            return True
+
+        self.stop_autosave()
+        self.close_all_views()
+        self.smart_homes_dict = state["smart_homes"]
+        self.next_smart_home_id = state["next_smart_home_id"]
+        self.create_widgets()
+        return True
 
     def save_state(self):
-        file_name = asksaveasfilename(defaultextension=".csv")
+        file_name = asksaveasfilename(
+            defaultextension=".csv",
+            filetypes=[("CSV files", "*.csv"), ("Compressed CSV files", "*.csv.gz *.csv.xz")]
+        )
         if not file_name:
             return
-        file = open(file_name, "w")
-        
-        for smart_home_name in self.smart_homes_dict:
-            smart_home = self.smart_homes_dict[smart_home_name][0].smart_home
-            values = [smart_home_name, str(smart_home.max_items)]
-
-            for device in smart_home.devices:
-                device_type = type(device).__name__
-                device_state = device.switched_on
-
-                if device_type == "SmartPlug":
-                    device_value = str(device.consumption_rate)
-                elif device_type == "SmartTV":
-                    device_value = str(device.channel)
-                elif device_type == "SmartWashingMachine":
-                    device_value = device.wash_mode
-                
-                values.append(device_type)
-                values.append(str(device_state))
-                values.append(str(device_value))
-
-            line = ",".join(values)
-            file.write(line + "\n")
-        
-        file.close()
 
+        self.record("save_state", None, file_name)
+        if self.store:
+            save_csv(file_name, self.iter_smart_homes(), level=self.save_compression_level, sparse=self.sparse_devices)
+            return
+
+        if self.auto_saver is None or self.auto_saver.file_name != file_name:
+            self.stop_autosave()
+            self.auto_saver = AutoSaver(
+                file_name, self.list_smart_homes, self.autosave_interval, self.sparse_devices, self.save_compression_level
+            )
+            self.auto_saver.report_callback = self.on_autosave_report
+            self.auto_saver.start()
+        self.auto_saver.request_save()
+
+    def list_smart_homes(self):
+        # called from the autosave thread, so take a copy of the dictionary first
+        return list(self.smart_homes_dict.items())
+
+
+def benchmark_view_registry(number_of_cycles=1000):
+    import gc
+    import time
+    import tracemalloc
 
-def main():
     app = SmartHomesApp()
+    app.create_widgets()
+    for i in range(5):
+        app.add_smart_home()
+    app.close_all_views()
+    smart_home_names = list(app.smart_homes_dict)
+
+    gc.collect()
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+
+    for i in range(number_of_cycles):
+        smart_home_name = smart_home_names[i % len(smart_home_names)]
+        app.modify_smart_home(smart_home_name)
+        app.modify_smart_home(smart_home_name)
+        app.win.update()
+        app.close_view(smart_home_name)
+
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    memory_growth = tracemalloc.get_traced_memory()[0] - start_memory
+    tracemalloc.stop()
+
+    print(f"{number_of_cycles} open/close cycles: {elapsed / number_of_cycles * 1000:.2f}ms each")
+    print(f"Open views: {len(app.views)}, Toplevels alive: {len(app.win.winfo_children()) - 1}")
+    print(f"Python memory growth: {memory_growth / 1024:.0f}KiB")
+    app.win.destroy()
+
+
+#benchmark_view_registry()
+def main():
+    renderer = "tree" if "--tree" in sys.argv else "widgets"
+    app = SmartHomesApp(renderer)
+
+    # --record trace.jsonl.gz logs the session so it can be replayed with workload.TraceReplayer
+    if "--record" in sys.argv:
+        app.start_recording(sys.argv[sys.argv.index("--record") + 1])
+    if "--fresh" not in sys.argv:
+        app.restore_last_session()
     app.run()
 
-main()
\ No newline at end of file
+# worker processes started by the parallel loader import this module, so only run the app directly
+if __name__ == "__main__":
+    main()
\ No newline at end of file
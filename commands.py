@@ -0,0 +1,243 @@
+import time
+
+
+class PendingDeviceCommand:
+
+    def __init__(self, device, priority, sequence):
+        self.device = device
+        self.priority = priority
+        self.sequence = sequence
+        self.switch_state = None
+        self.toggles = 0
+        self.has_value = False
+        self.value = None
+        self.remove = False
+
+
+class CommandQueue:
+
+    def __init__(self, smart_home, max_pending=None, max_delay=None, clock=time.monotonic):
+        # flush policy: flush once max_pending devices have queued commands or the oldest
+        # command is max_delay seconds old, flush() can always be called directly
+        self.smart_home = smart_home
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.clock = clock
+
+        self.pending = {}
+        self.next_sequence = 0
+        self.oldest_enqueue_time = None
+
+        self.ops_enqueued = 0
+        self.ops_applied = 0
+
+        # commands that still failed when applied (e.g. over a power budget), with their errors
+        self.ops_failed = 0
+        self.errors = []
+
+    @property
+    def ops_eliminated(self):
+        return self.ops_enqueued - self.ops_applied - self.ops_failed - self.ops_queued()
+
+    def ops_queued(self):
+        count = 0
+        for command in self.pending.values():
+            count += self.count_ops(command)
+        return count
+
+    def count_ops(self, command):
+        if command.remove:
+            return 1
+        count = 1 if command.has_value else 0
+        if command.switch_state is not None:
+            count += 1
+        if command.toggles % 2:
+            count += 1
+        return count
+
+    def visible_indexes(self):
+        # indexes into the home of the devices as the caller sees them, with queued removals
+        # already applied
+        return [
+            i for i, device in enumerate(self.smart_home.devices)
+            if not (id(device) in self.pending and self.pending[id(device)].remove)
+        ]
+
+    def device_for(self, index):
+        # through get_device, so a SparseSmartHome hands out a real device to queue against
+        indexes = self.visible_indexes()
+        if not 0 <= index < len(indexes):
+            raise IndexError("Invalid index! Out of range")
+        return self.smart_home.get_device(indexes[index])
+
+    def command_for(self, index, priority):
+        return self.command_for_device(self.device_for(index), priority)
+
+    def command_for_device(self, device, priority):
+        command = self.pending.get(id(device))
+        if command is None:
+            command = PendingDeviceCommand(device, priority, self.next_sequence)
+            self.next_sequence += 1
+            self.pending[id(device)] = command
+            if self.oldest_enqueue_time is None:
+                self.oldest_enqueue_time = self.clock()
+        else:
+            command.priority = max(command.priority, priority)
+        return command
+
+    def toggle(self, index, priority=0):
+        command = self.command_for(index, priority)
+        command.toggles += 1
+        self.enqueued()
+
+    def update_option(self, index, value, priority=0):
+        # bad values are rejected now rather than halfway through a flush
+        device = self.device_for(index)
+        self.smart_home.validate_option(device, value)
+
+        command = self.command_for_device(device, priority)
+        command.has_value = True
+        command.value = value
+        self.enqueued()
+
+    def remove(self, index, priority=0):
+        command = self.command_for(index, priority)
+        command.remove = True
+        command.has_value = False
+        command.switch_state = None
+        command.toggles = 0
+        self.enqueued()
+
+    def switch_all(self, switched_on, priority=0):
+        # counted as one operation per device, since that is what it may cost when applied
+        indexes = self.visible_indexes()
+        for i in indexes:
+            command = self.command_for_device(self.smart_home.get_device(i), priority)
+            command.switch_state = switched_on
+            command.toggles = 0
+        self.enqueued(len(indexes))
+
+    def switch_all_on(self, priority=0):
+        self.switch_all(True, priority)
+
+    def switch_all_off(self, priority=0):
+        self.switch_all(False, priority)
+
+    def enqueued(self, count=1):
+        self.ops_enqueued += count
+
+        if self.max_pending is not None and len(self.pending) >= self.max_pending:
+            self.flush()
+        elif self.max_delay is not None and self.clock() - self.oldest_enqueue_time >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        commands = sorted(self.pending.values(), key=lambda command: (-command.priority, command.sequence))
+
+        for command in commands:
+            del self.pending[id(command.device)]
+            ops_applied = self.ops_applied
+            try:
+                self.apply(command)
+            except (ValueError, TypeError, IndexError) as e:
+                self.ops_failed += self.count_ops(command) - (self.ops_applied - ops_applied)
+                self.errors.append((command.device, e))
+
+        self.oldest_enqueue_time = None
+        return self.ops_applied
+
+    def apply(self, command):
+        try:
+            index = self.smart_home.devices.index(command.device)
+        except ValueError:
+            # removed or replaced behind the queue's back, counted as failed rather than eliminated
+            raise IndexError("Device is no longer in the SmartHome")
+
+        if command.remove:
+            self.smart_home.remove_device(index)
+            self.ops_applied += 1
+            return
+
+        if command.has_value:
+            self.smart_home.update_option(index, command.value)
+            self.ops_applied += 1
+
+        switched_on = command.device.switched_on
+        if command.switch_state is not None:
+            switched_on = command.switch_state
+        if command.toggles % 2:
+            switched_on = not switched_on
+
+        if switched_on != command.device.switched_on:
+            self.smart_home.toggle_device(index)
+            self.ops_applied += 1
+
+    def report(self):
+        return {
+            "ops_enqueued": self.ops_enqueued,
+            "ops_applied": self.ops_applied,
+            "ops_eliminated": self.ops_eliminated,
+            "ops_failed": self.ops_failed,
+            "ops_queued": self.ops_queued(),
+        }
+
+
+def benchmark_command_queue(number_of_steps=100000, flush_every=50):
+    import random
+    from backend import SmartHome, SmartPlug, SmartTV, SmartWashingMachine
+
+    def build_home():
+        smart_home = SmartHome()
+        smart_home.add_device(SmartPlug(50))
+        smart_home.add_device(SmartTV())
+        smart_home.add_device(SmartWashingMachine())
+        smart_home.add_device(SmartTV())
+        smart_home.add_device(SmartPlug(100))
+        return smart_home
+
+    # automation trace: bursts of toggles, channel surfing and mode changes
+    random.seed(1)
+    trace = []
+    for i in range(number_of_steps):
+        index = random.randrange(5)
+        option = random.random()
+        if option < 0.5:
+            trace.append(("toggle", index, None))
+        elif index in (1, 3):
+            trace.append(("update_option", index, random.randint(1, 734)))
+        elif index == 2:
+            trace.append(("update_option", index, random.choice(["Daily wash", "Quick wash", "Eco"])))
+        else:
+            trace.append(("update_option", index, random.randint(0, 150)))
+
+    direct_home = build_home()
+    start = time.perf_counter()
+    for operation, index, value in trace:
+        if operation == "toggle":
+            direct_home.toggle_device(index)
+        else:
+            direct_home.update_option(index, value)
+    direct_time = time.perf_counter() - start
+
+    queued_home = build_home()
+    command_queue = CommandQueue(queued_home)
+    start = time.perf_counter()
+    for i, (operation, index, value) in enumerate(trace):
+        if operation == "toggle":
+            command_queue.toggle(index)
+        else:
+            command_queue.update_option(index, value)
+        if (i + 1) % flush_every == 0:
+            command_queue.flush()
+    command_queue.flush()
+    queued_time = time.perf_counter() - start
+
+    same_state = [str(device) for device in direct_home.devices] == [str(device) for device in queued_home.devices]
+
+    print(f"Command queue with {number_of_steps} operations, flushing every {flush_every}:")
+    print(f"Direct: {number_of_steps} operations applied in {direct_time:.3f}s")
+    print(f"Queued: {command_queue.report()} in {queued_time:.3f}s")
+    print(f"Final state matches: {same_state}")
+
+
+#benchmark_command_queue()
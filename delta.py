@@ -0,0 +1,264 @@
+import hashlib
+import json
+import time
+from backend import SmartHome
+from savefile import device_value, create_device, smart_home_to_csv_line
+
+
+DELTA_FORMAT_VERSION = 1
+
+
+def home_digest(smart_home_name, smart_home):
+    line = smart_home_to_csv_line(smart_home_name, smart_home).encode()
+    return int.from_bytes(hashlib.blake2b(line, digest_size=8).digest(), "little")
+
+
+def device_fields(device):
+    return [type(device).__name__, device.switched_on, device_value(device)]
+
+
+class HomeVersions:
+
+    def __init__(self, smart_home, version):
+        self.created_version = version
+        self.home_version = version
+        self.structure_version = version
+        self.device_versions = [version] * len(smart_home.devices)
+        self.listener = None
+
+
+class DeltaTracker:
+
+    # the fleet checksum is the XOR of one digest per home, so it is kept up to date per change
+    def __init__(self):
+        self.version = 0
+        self.homes = {}
+        self.tracked = {}
+        self.removed = {}
+        self.digests = {}
+        self.checksum = 0
+
+    def track(self, smart_home_name, smart_home):
+        self.untrack(smart_home_name, removed=False)
+        self.version += 1
+        self.removed.pop(smart_home_name, None)
+
+        home_versions = HomeVersions(smart_home, self.version)
+
+        def listener(smart_home, event, index, device):
+            self.on_change(smart_home_name, event, index)
+
+        home_versions.listener = listener
+        smart_home.listeners.append(listener)
+        self.homes[smart_home_name] = smart_home
+        self.tracked[smart_home_name] = home_versions
+        self.update_digest(smart_home_name)
+
+    def track_all(self, smart_homes):
+        for smart_home_name, smart_home in smart_homes:
+            self.track(smart_home_name, smart_home)
+
+    def untrack(self, smart_home_name, removed=True):
+        if smart_home_name not in self.tracked:
+            return
+
+        home_versions = self.tracked.pop(smart_home_name)
+        smart_home = self.homes.pop(smart_home_name)
+        if home_versions.listener in smart_home.listeners:
+            smart_home.listeners.remove(home_versions.listener)
+
+        self.checksum ^= self.digests.pop(smart_home_name)
+        if removed:
+            self.version += 1
+            self.removed[smart_home_name] = self.version
+
+    def update_digest(self, smart_home_name):
+        self.checksum ^= self.digests.get(smart_home_name, 0)
+        self.digests[smart_home_name] = home_digest(smart_home_name, self.homes[smart_home_name])
+        self.checksum ^= self.digests[smart_home_name]
+
+    def on_change(self, smart_home_name, event, index):
+        self.version += 1
+        home_versions = self.tracked[smart_home_name]
+        home_versions.home_version = self.version
+
+        if event == "update":
+            home_versions.device_versions[index] = self.version
+        elif event == "add":
+            home_versions.device_versions.append(self.version)
+            home_versions.structure_version = self.version
+        elif event == "remove":
+            del home_versions.device_versions[index]
+            home_versions.structure_version = self.version
+        elif event == "update_all":
+            home_versions.device_versions = [self.version] * len(home_versions.device_versions)
+        else:
+            home_versions.device_versions = [self.version] * len(self.homes[smart_home_name].devices)
+            home_versions.structure_version = self.version
+
+        self.update_digest(smart_home_name)
+
+    def export_delta(self, since_version=0):
+        # everything added, removed or changed after since_version, export_delta(0) is a full copy
+        added = []
+        changed = []
+
+        for smart_home_name, home_versions in self.tracked.items():
+            if home_versions.home_version <= since_version:
+                continue
+            smart_home = self.homes[smart_home_name]
+
+            if home_versions.created_version > since_version:
+                added.append({
+                    "name": smart_home_name,
+                    "max_items": smart_home.max_items,
+                    "devices": [device_fields(device) for device in smart_home.devices],
+                })
+            elif home_versions.structure_version > since_version:
+                changed.append({
+                    "name": smart_home_name,
+                    "max_items": smart_home.max_items,
+                    "devices": [device_fields(device) for device in smart_home.devices],
+                })
+            else:
+                changed.append({
+                    "name": smart_home_name,
+                    "device_updates": [
+                        [i] + device_fields(smart_home.get_device(i))
+                        for i, device_version in enumerate(home_versions.device_versions)
+                        if device_version > since_version
+                    ],
+                })
+
+        removed = [
+            smart_home_name for smart_home_name, version in self.removed.items()
+            if version > since_version
+        ]
+
+        return {
+            "format": DELTA_FORMAT_VERSION,
+            "from_version": since_version,
+            "to_version": self.version,
+            "added": added,
+            "changed": changed,
+            "removed": removed,
+            "checksum": self.checksum,
+        }
+
+    def apply_delta(self, delta, smart_homes):
+        # smart_homes is the live name -> SmartHome dictionary of this instance. Every new
+        # device list is built and the resulting checksum verified before anything is touched,
+        # so a delta that does not fit leaves the instance unchanged.
+        if delta.get("format") != DELTA_FORMAT_VERSION:
+            raise ValueError("Unsupported delta format")
+
+        staged = {}
+        for entry in delta["added"]:
+            devices = [create_device(*fields) for fields in entry["devices"]]
+            staged[entry["name"]] = (entry["max_items"], devices)
+
+        for entry in delta["changed"]:
+            smart_home_name = entry["name"]
+            if smart_home_name not in smart_homes:
+                raise ValueError(f"Delta changes unknown home: {smart_home_name}")
+
+            smart_home = smart_homes[smart_home_name]
+            if "devices" in entry:
+                devices = [create_device(*fields) for fields in entry["devices"]]
+                staged[smart_home_name] = (entry["max_items"], devices)
+            else:
+                devices = [create_device(*device_fields(device)) for device in smart_home.devices]
+                for index, device_type, device_state, value in entry["device_updates"]:
+                    if not 0 <= index < len(devices):
+                        raise ValueError(f"Delta updates missing device {index} of {smart_home_name}")
+                    devices[index] = create_device(device_type, device_state, value)
+                staged[smart_home_name] = (smart_home.max_items, devices)
+
+        removed = [smart_home_name for smart_home_name in delta["removed"] if smart_home_name in smart_homes]
+
+        checksum = self.checksum
+        staged_digests = {}
+        for smart_home_name in removed:
+            checksum ^= self.digests.get(smart_home_name, 0)
+        for smart_home_name, (max_items, devices) in staged.items():
+            staged_home = SmartHome(max_items)
+            staged_home.replace_devices(devices)
+            checksum ^= self.digests.get(smart_home_name, 0)
+            staged_digests[smart_home_name] = home_digest(smart_home_name, staged_home)
+            checksum ^= staged_digests[smart_home_name]
+
+        if checksum != delta["checksum"]:
+            raise ValueError("Delta checksum does not match, a full reload is needed")
+
+        for smart_home_name in removed:
+            self.untrack(smart_home_name)
+            del smart_homes[smart_home_name]
+
+        for smart_home_name, (max_items, devices) in staged.items():
+            if smart_home_name in smart_homes:
+                smart_homes[smart_home_name].replace_devices(devices, max_items)
+            else:
+                smart_home = SmartHome(max_items)
+                smart_home.replace_devices(devices)
+                smart_homes[smart_home_name] = smart_home
+                self.track(smart_home_name, smart_home)
+
+        return len(staged) + len(removed)
+
+
+def delta_to_bytes(delta):
+    return json.dumps(delta, separators=(",", ":")).encode()
+
+
+def delta_from_bytes(data):
+    return json.loads(data.decode())
+
+
+def benchmark_delta(number_of_homes=100000, number_of_changed_homes=100):
+    import os
+    import random
+    import tempfile
+    from fleetgen import FleetGenerator
+    from savefile import save_csv, load_csv
+
+    primary_homes = dict(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+    standby_homes = dict(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+
+    primary = DeltaTracker()
+    primary.track_all(primary_homes.items())
+    standby = DeltaTracker()
+    standby.track_all(standby_homes.items())
+    synced_version = primary.version
+
+    random.seed(1)
+    names = list(primary_homes)
+    for smart_home_name in random.sample(names, number_of_changed_homes):
+        smart_home = primary_homes[smart_home_name]
+        if smart_home.devices:
+            smart_home.toggle_device(0)
+    primary_homes["Smart Home new"] = SmartHome()
+    primary.track("Smart Home new", primary_homes["Smart Home new"])
+    primary.untrack(names[0])
+    del primary_homes[names[0]]
+
+    start = time.perf_counter()
+    data = delta_to_bytes(primary.export_delta(synced_version))
+    export_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    standby.apply_delta(delta_from_bytes(data), standby_homes)
+    apply_time = time.perf_counter() - start
+
+    file_name = os.path.join(tempfile.mkdtemp(), "full.csv")
+    save_csv(file_name, primary_homes.items())
+    start = time.perf_counter()
+    load_csv(file_name)
+    full_reload_time = time.perf_counter() - start
+
+    print(f"Syncing {number_of_homes} homes after {number_of_changed_homes} changes:")
+    print(f"Delta: {len(data)} bytes, export {export_time * 1000:.1f}ms, apply {apply_time * 1000:.1f}ms")
+    print(f"Full CSV: {os.path.getsize(file_name)} bytes, reload {full_reload_time * 1000:.1f}ms")
+    print(f"Checksums match: {primary.checksum == standby.checksum}")
+
+
+#benchmark_delta()
@@ -0,0 +1,157 @@
+import os
+import random
+import time
+from backend import SmartPlug, SmartTV
+from savefile import open_save_file, smart_home_from_record
+from storage import SQLiteStore
+
+
+DEFAULT_DEVICE_MIX = {
+    "SmartPlug": 5,
+    "SmartTV": 3,
+    "SmartWashingMachine": 2,
+}
+
+DEFAULT_SWITCHED_ON_PROBABILITY = {
+    "SmartPlug": 0.5,
+    "SmartTV": 0.3,
+    "SmartWashingMachine": 0.1,
+}
+
+DEFAULT_WASH_MODE_WEIGHTS = {
+    "Daily wash": 6,
+    "Quick wash": 3,
+    "Eco": 1,
+}
+
+
+class FleetGenerator:
+
+    # the same seed and settings give the same fleet on every machine
+    def __init__(
+        self,
+        seed=0,
+        device_mix=None,
+        devices_per_home=(1, 5),
+        max_items=5,
+        switched_on_probability=None,
+        wash_mode_weights=None,
+        channel_skew=1.2,
+        first_smart_home_id=1
+    ):
+        self.seed = seed
+        self.device_mix = device_mix or DEFAULT_DEVICE_MIX
+        self.devices_per_home = devices_per_home
+        self.max_items = max_items
+        self.switched_on_probability = switched_on_probability or DEFAULT_SWITCHED_ON_PROBABILITY
+        self.wash_mode_weights = wash_mode_weights or DEFAULT_WASH_MODE_WEIGHTS
+        self.channel_skew = channel_skew
+        self.first_smart_home_id = first_smart_home_id
+
+        if devices_per_home[1] > max_items:
+            raise ValueError("devices_per_home can't be larger than max_items")
+
+    def generate_records(self, number_of_homes):
+        # compact (smart_home_name, max_items, devices) records, the same shape the parallel loader uses
+        rng = random.Random(self.seed)
+        device_types = list(self.device_mix)
+        device_weights = list(self.device_mix.values())
+        wash_modes = list(self.wash_mode_weights)
+        wash_mode_weights = list(self.wash_mode_weights.values())
+        min_devices, max_devices = self.devices_per_home
+
+        for i in range(number_of_homes):
+            number_of_devices = rng.randint(min_devices, max_devices)
+            devices = []
+
+            for device_type in rng.choices(device_types, device_weights, k=number_of_devices):
+                device_state = rng.random() < self.switched_on_probability.get(device_type, 0)
+
+                if device_type == "SmartPlug":
+                    device_value = rng.randint(SmartPlug.min_consumption_rate, SmartPlug.max_consumption_rate)
+                elif device_type == "SmartTV":
+                    # a few channels are far more popular than the rest
+                    device_value = min(SmartTV.max_channel, int(rng.paretovariate(self.channel_skew)))
+                elif device_type == "SmartWashingMachine":
+                    device_value = rng.choices(wash_modes, wash_mode_weights)[0]
+                else:
+                    raise ValueError(f"Unknown device type: {device_type}")
+
+                devices.append((device_type, device_state, device_value))
+
+            yield f"Smart Home {self.first_smart_home_id + i}", self.max_items, devices
+
+    def generate_fleet(self, number_of_homes):
+        for record in self.generate_records(number_of_homes):
+            yield smart_home_from_record(record)
+
+    def write_fleet(self, file_name, number_of_homes, compression=None, level=None, batch_size=10000):
+        # .db files go through SQLiteStore, everything else is written as a (possibly compressed) save
+        if file_name.endswith(".db"):
+            store = SQLiteStore(file_name)
+            batch = []
+            for smart_home in self.generate_fleet(number_of_homes):
+                batch.append(smart_home)
+                if len(batch) >= batch_size:
+                    store.save_homes(batch)
+                    batch = []
+            if batch:
+                store.save_homes(batch)
+            store.close()
+            return
+
+        with open_save_file(file_name, "w", compression, level) as file:
+            for smart_home_name, max_items, devices in self.generate_records(number_of_homes):
+                values = [smart_home_name, str(max_items)]
+                for device_type, device_state, device_value in devices:
+                    values.append(device_type)
+                    values.append(str(device_state))
+                    values.append(str(device_value))
+                file.write(",".join(values) + "\n")
+
+
+def generate_fleet(number_of_homes, seed=0, **settings):
+    return FleetGenerator(seed, **settings).generate_fleet(number_of_homes)
+
+
+def write_fleet(file_name, number_of_homes, seed=0, compression=None, level=None, **settings):
+    FleetGenerator(seed, **settings).write_fleet(file_name, number_of_homes, compression, level)
+
+
+def benchmark_fleet_generator(number_of_homes=300000):
+    import tempfile
+    from savefile import iter_csv
+
+    directory = tempfile.mkdtemp()
+    generator = FleetGenerator(seed=42)
+    number_of_devices = sum(len(record[2]) for record in generator.generate_records(number_of_homes))
+
+    print(f"Generating {number_of_homes} homes with {number_of_devices} devices:")
+
+    start = time.perf_counter()
+    for smart_home_name, smart_home in generator.generate_fleet(number_of_homes):
+        pass
+    elapsed = time.perf_counter() - start
+    print(f"SmartHome objects: {elapsed:.2f}s, {number_of_devices / elapsed * 60 / 1000000:.1f}M devices/minute")
+
+    for extension in (".csv", ".csv.gz", ".db"):
+        file_name = os.path.join(directory, f"fleet{extension}")
+        start = time.perf_counter()
+        generator.write_fleet(file_name, number_of_homes)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{extension}: {elapsed:.2f}s, {number_of_devices / elapsed * 60 / 1000000:.1f}M devices/minute, "
+            f"{os.path.getsize(file_name) / 1024 / 1024:.1f}MiB"
+        )
+
+    # the same seed has to produce the same file again
+    file_name = os.path.join(directory, "fleet-again.csv")
+    generator.write_fleet(file_name, number_of_homes)
+    with open(file_name, "rb") as first, open(os.path.join(directory, "fleet.csv"), "rb") as second:
+        print(f"Deterministic: {first.read() == second.read()}")
+
+    loaded = sum(1 for smart_home in iter_csv(os.path.join(directory, "fleet.csv.gz")))
+    print(f"Homes loaded back from .csv.gz: {loaded}")
+
+
+#benchmark_fleet_generator()
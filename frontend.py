@@ -1,13 +1,14 @@
-from tkinter import Tk, Frame, Label, Button, Toplevel, Entry, StringVar, OptionMenu
-from backend import SmartPlug, SmartTV, SmartWashingMachine, SmartHome
+from tkinter import Tk, Frame, Label, Button, Toplevel, Entry, StringVar, OptionMenu, Menu, Scrollbar
+from tkinter import ttk, messagebox
+from backend import SmartPlug, SmartTV, SmartWashingMachine, SmartHome, create_default_smart_home
 
 class SmartHomeApp:
 
-    def __init__(self, win):
-        self.smart_home = SmartHome()
-        self.smart_home.add_device(SmartTV())
-        self.smart_home.add_device(SmartWashingMachine())
-        self.smart_home.add_device(SmartPlug())
+    def __init__(self, win, renderer="widgets", smart_home=None):
+        # the SmartHome is the model, a view is given one or starts with the default devices
+        if smart_home is None:
+            smart_home = self.create_default_smart_home()
+        self.smart_home = smart_home
         
         self.update_parent_win = None
 
@@ -39,6 +40,24 @@ class SmartHomeApp:
 
         self.device_widgets = []
 
+        # "widgets" draws a label and three buttons per device, "tree" draws one Treeview for all devices
+        self.renderer = renderer
+        self.device_tree = None
+        self.context_menu = None
+        self.context_menu_index = None
+
+        # the edit and add dialogs are created on first use and reused afterwards
+        self.edit_dialog = None
+        self.add_dialog = None
+
+        # set to a workload.TraceRecorder to log every operation made through this view
+        self.recorder = None
+        self.smart_home_name = None
+
+    @staticmethod
+    def create_default_smart_home():
+        return create_default_smart_home()
+
     def calc_centre_of_screen(self):
         screen_width = self.win.winfo_screenwidth()
         screen_height = self.win.winfo_screenheight()
@@ -51,8 +70,31 @@ class SmartHomeApp:
     def run(self):
         self.create_widgets()
         self.win.mainloop()
+
+    def record(self, operation, *arguments):
+        if self.recorder:
+            self.recorder.record(operation, self.smart_home_name, *arguments)
     
+    def describe_device(self, device):
+        device_type = type(device).__name__
+        device_state = "On" if device.switched_on else "Off"
+        
+        if device_type == "SmartTV":
+            device_attribute = f"Channel: {device.channel}"
+        elif device_type == "SmartWashingMachine":
+            device_attribute = f"Wash Mode: {device.wash_mode}"
+        elif device_type == "SmartPlug":
+            device_attribute = f"Consumption: {device.consumption_rate}W"
+        else:
+            device_attribute = "Unknown Attribute"
+
+        return device_type, device_state, device_attribute
+
     def create_widgets(self):
+        if self.renderer == "tree":
+            self.create_tree_widgets()
+            return
+
         self.delete_all_device_widgets()
 
         title_label = Label(
@@ -106,17 +148,7 @@ class SmartHomeApp:
         
         for i in range(count_devices):
             device = self.smart_home.devices[i]
-            device_type = type(device).__name__
-            device_state = "On" if device.switched_on else "Off"
-            
-            if device_type == "SmartTV":
-                device_attribute = f"Channel: {device.channel}"
-            elif device_type == "SmartWashingMachine":
-                device_attribute = f"Wash Mode: {device.wash_mode}"
-            elif device_type == "SmartPlug":
-                device_attribute = f"Consumption: {device.consumption_rate}W"
-            else:
-                device_attribute = "Unknown Attribute"
+            device_type, device_state, device_attribute = self.describe_device(device)
 
             device_label = Label(
                 self.main_frame,
@@ -205,19 +237,154 @@ class SmartHomeApp:
         
         self.win.geometry(f"{self.window_width}x{(self.window_height // 2) + (count_devices * 40)}")
 
+    def create_tree_widgets(self):
+        # the widgets are built once, later calls only refill the rows
+        if self.device_tree is None:
+            title_label = Label(
+                self.main_frame,
+                text="Smart Home",
+                font=("Arial"),
+            )
+            title_label.grid(
+                row=0,
+                column=0,
+                columnspan=5,
+                sticky="ew"
+            )
+
+            turn_on_all_button = Button(
+                self.main_frame,
+                text="Turn All On",
+                font=("Arial", 11),
+                bg="white",
+                bd=1,
+                command=self.turn_all_on
+            )
+            turn_on_all_button.grid(
+                row=1,
+                column=0,
+                columnspan=2,
+                sticky="ew",
+                padx=5,
+                pady=5,
+            )
+
+            turn_off_all_button = Button(
+                self.main_frame,
+                text="Turn All Off",
+                font=("Arial", 11),
+                bg="white",
+                bd=1,
+                command=self.turn_all_off
+            )
+            turn_off_all_button.grid(
+                row=1,
+                column=2,
+                columnspan=3,
+                sticky="ew",
+                padx=5,
+                pady=5
+            )
+
+            self.device_tree = ttk.Treeview(
+                self.main_frame,
+                columns=("type", "state", "attribute"),
+                show="headings",
+                selectmode="browse",
+                height=8
+            )
+            self.device_tree.heading("type", text="Device")
+            self.device_tree.heading("state", text="State")
+            self.device_tree.heading("attribute", text="Setting")
+            self.device_tree.grid(
+                row=2,
+                column=0,
+                columnspan=5,
+                sticky="nsew",
+                padx=5,
+                pady=5
+            )
+
+            tree_scrollbar = Scrollbar(self.main_frame, command=self.device_tree.yview)
+            tree_scrollbar.grid(row=2, column=5, sticky="ns")
+            self.device_tree.configure(yscrollcommand=tree_scrollbar.set)
+
+            add_device_button = Button(
+                self.main_frame,
+                text="Add Device",
+                font=("Arial", 11),
+                bg="white",
+                bd=1,
+                command=self.add_device
+            )
+            add_device_button.grid(
+                row=3,
+                column=0,
+                columnspan=5,
+                sticky="ew",
+                padx=5,
+                pady=5,
+            )
+
+            self.context_menu = Menu(self.win, tearoff=0)
+            self.context_menu.add_command(label="Toggle", command=lambda: self.on_context_menu(self.toggle_device))
+            self.context_menu.add_command(label="Edit", command=lambda: self.on_context_menu(self.edit_device))
+            self.context_menu.add_command(label="Delete", command=lambda: self.on_context_menu(self.delete_device))
+
+            self.device_tree.bind("<Double-1>", self.on_device_tree_event)
+            self.device_tree.bind("<Button-3>", self.on_device_tree_event)
+            self.device_tree.bind("<Return>", self.on_device_tree_event)
+
+            self.win.geometry(f"{self.window_width}x{self.window_height + 80}")
+
+        self.device_tree.delete(*self.device_tree.get_children())
+        for i in range(len(self.smart_home.devices)):
+            self.device_tree.insert("", "end", iid=str(i), values=self.describe_device(self.smart_home.devices[i]))
+
+    def on_device_tree_event(self, event):
+        # one handler for every row, the row is found by hit-testing the event position
+        if event.keysym == "Return":
+            row = self.device_tree.focus()
+        else:
+            row = self.device_tree.identify_row(event.y)
+        if not row:
+            return
+
+        index = int(row)
+        self.device_tree.selection_set(row)
+
+        if event.num == 3:
+            self.context_menu_index = index
+            self.context_menu.tk_popup(event.x_root, event.y_root)
+        elif event.keysym == "Return":
+            self.edit_device(index)
+        else:
+            self.toggle_device(index)
+
+    def on_context_menu(self, action):
+        if self.context_menu_index is not None:
+            action(self.context_menu_index)
+            self.context_menu_index = None
+
     def delete_all_device_widgets(self):
         for widget in self.device_widgets:
             widget.destroy()
         self.device_widgets = []
 
     def turn_all_on(self):
-        self.smart_home.switch_all_on()
+        self.record("switch_all_on")
+        try:
+            self.smart_home.switch_all_on()
+        except ValueError as e:
+            messagebox.showerror("Power Budget", str(e), parent=self.win)
+            return
         self.create_widgets()
 
         if self.update_parent_win:
             self.update_parent_win()
 
     def turn_all_off(self):
+        self.record("switch_all_off")
         self.smart_home.switch_all_off()
         self.create_widgets()
 
@@ -225,114 +392,178 @@ class SmartHomeApp:
             self.update_parent_win()
 
     def toggle_device(self, index):
-        self.smart_home.toggle_device(index)
+        self.record("toggle_device", index)
+        try:
+            self.smart_home.toggle_device(index)
+        except ValueError as e:
+            messagebox.showerror("Power Budget", str(e), parent=self.win)
+            return
         self.create_widgets()
 
         if self.update_parent_win:
             self.update_parent_win()
 
-    def edit_device(self, index):
-        device = self.smart_home.get_device(index)
-        device_type = type(device).__name__
-        
-        edit_win = Toplevel(self.win)
-        edit_win.title(f"Edit {device_type}")
+    def edit_device(self, index, modal=False):
+        # one dialog per app, repopulated for each device instead of rebuilt
+        if self.edit_dialog is None:
+            self.edit_dialog = EditDeviceDialog(self)
+        self.edit_dialog.show(index, modal)
+    
+    def delete_device(self, index):
+        self.record("remove_device", index)
+        self.smart_home.remove_device(index)
+        self.create_widgets()
+
+        if self.update_parent_win:
+                    self.update_parent_win()
+
+    def add_device(self, modal=False):
+        if self.add_dialog is None:
+            self.add_dialog = AddDeviceDialog(self)
+        self.add_dialog.show(modal)
 
-        x_position, y_position = self.calc_centre_of_screen()
-        edit_win.geometry(f"330x200+{x_position + self.window_width // 3}+{y_position + self.window_height // 3}")
-
-        device_type_to_instruction_dict = {
-            "SmartPlug": "Enter Consumption Rate:",
-            "SmartTV": "Enter Channel:",
-            "SmartWashingMachine": "Enter Wash Mode:"
-        }
-
-        user_instruction_text = device_type_to_instruction_dict.get(device_type)
-        user_instruction_label = Label(
-            edit_win,
-            text=user_instruction_text,
-            font=("Arial", 11)
-        )
-        user_instruction_label.pack(padx=10, pady=10)
 
-        option_entry_text_var = StringVar(edit_win)
-        option_entry = Entry(
-            edit_win,
-            textvariable=option_entry_text_var
+class DeviceDialog:
+
+    # built once and withdrawn when closed, show() grabs input so the dialog is modal
+    # without a nested mainloop(), modal=True also waits until it is closed again
+    def __init__(self, app, title):
+        self.app = app
+        self.dialog_win = Toplevel(app.win)
+        self.dialog_win.title(title)
+        self.dialog_win.withdraw()
+        self.dialog_win.protocol("WM_DELETE_WINDOW", self.hide)
+        self.closed_var = StringVar(self.dialog_win)
+
+    def place(self):
+        x_position, y_position = self.app.calc_centre_of_screen()
+        self.dialog_win.geometry(
+            f"330x200+{x_position + self.app.window_width // 3}+{y_position + self.app.window_height // 3}"
         )
-        option_entry.pack(padx=10, pady=10)
 
-        def save_value():
-            value = option_entry_text_var.get().strip()
-            
-            if value.strip() == "":
-                error_info_label.config(text="Value cannot be empty")
-                return
-            
-            try:
-                if device_type == "SmartWashingMachine":
-                    self.smart_home.update_option(index, value)
-                
-                elif device_type == "SmartTV" or device_type == "SmartPlug":
-                    int_value = self.smart_home.attempt_conversion_to_int(value)
-                    self.smart_home.update_option(index, int_value)
-
-                edit_win.destroy()
-                self.create_widgets()
-
-                if self.update_parent_win:
-                    self.update_parent_win()
+    def open(self, modal):
+        self.place()
+        self.closed_var.set("")
+        self.dialog_win.deiconify()
+        self.dialog_win.lift()
+        self.dialog_win.grab_set()
+
+        if modal:
+            self.dialog_win.wait_variable(self.closed_var)
+
+    def hide(self):
+        self.dialog_win.grab_release()
+        self.dialog_win.withdraw()
+        self.closed_var.set("closed")
 
-            except (ValueError, TypeError, IndexError) as e:
-                error_info_label.config(text=e)
-                edit_win.geometry(f"{len(str(e)) * 8}x200")
+    def show_error(self, e):
+        self.error_info_label.config(text=e)
+        self.dialog_win.geometry(f"{len(str(e)) * 8}x200")
+
+    def saved(self):
+        self.hide()
+        self.app.create_widgets()
+
+        if self.app.update_parent_win:
+            self.app.update_parent_win()
+
+
+class EditDeviceDialog(DeviceDialog):
+
+    device_type_to_instruction_dict = {
+        "SmartPlug": "Enter Consumption Rate:",
+        "SmartTV": "Enter Channel:",
+        "SmartWashingMachine": "Enter Wash Mode:"
+    }
+
+    def __init__(self, app):
+        super().__init__(app, "Edit Device")
+        self.index = None
+        self.device_type = None
+
+        self.user_instruction_label = Label(
+            self.dialog_win,
+            font=("Arial", 11)
+        )
+        self.user_instruction_label.pack(padx=10, pady=10)
+
+        self.option_entry_text_var = StringVar(self.dialog_win)
+        self.option_entry = Entry(
+            self.dialog_win,
+            textvariable=self.option_entry_text_var
+        )
+        self.option_entry.pack(padx=10, pady=10)
+        self.option_entry.bind("<Return>", lambda event: self.save_value())
 
         save_button = Button(
-            edit_win,
+            self.dialog_win,
             text="Save",
             font=("Arial", 11),
             bg="white",
             bd=1,
-            command=save_value
+            command=self.save_value
         )
         save_button.pack(padx=5, pady=5)
 
-        error_info_label = Label(
-            edit_win,
+        self.error_info_label = Label(
+            self.dialog_win,
             fg="red",
             font=("Arial", 11)
         )
-        error_info_label.pack(padx=10, pady=10)
+        self.error_info_label.pack(padx=10, pady=10)
+
+    def show(self, index, modal=False):
+        device = self.app.smart_home.get_device(index)
+        self.index = index
+        self.device_type = type(device).__name__
+
+        self.dialog_win.title(f"Edit {self.device_type}")
+        self.user_instruction_label.config(text=self.device_type_to_instruction_dict.get(self.device_type))
+        self.option_entry_text_var.set("")
+        self.error_info_label.config(text="")
+        self.open(modal)
+        self.option_entry.focus_set()
+
+    def save_value(self):
+        value = self.option_entry_text_var.get().strip()
+        
+        if value == "":
+            self.error_info_label.config(text="Value cannot be empty")
+            return
+        
+        self.app.record("update_option", self.index, value)
+        try:
+            if self.device_type == "SmartWashingMachine":
+                self.app.smart_home.update_option(self.index, value)
+            
+            elif self.device_type == "SmartTV" or self.device_type == "SmartPlug":
+                int_value = self.app.smart_home.attempt_conversion_to_int(value)
+                self.app.smart_home.update_option(self.index, int_value)
 
-        edit_win.mainloop()
-    
-    def delete_device(self, index):
-        self.smart_home.remove_device(index)
-        self.create_widgets()
+            self.saved()
 
-        if self.update_parent_win:
-                    self.update_parent_win()
+        except (ValueError, TypeError, IndexError) as e:
+            self.show_error(e)
 
-    def add_device(self):
-        add_win = Toplevel(self.win)
-        add_win.title("Add Device")
 
-        x_position, y_position = self.calc_centre_of_screen()
-        add_win.geometry(f"330x200+{x_position + self.window_width // 3}+{y_position + self.window_height // 3}")
+class AddDeviceDialog(DeviceDialog):
+
+    def __init__(self, app):
+        super().__init__(app, "Add Device")
 
         dropdown_label = Label(
-            add_win,
+            self.dialog_win,
             text="Select Device Type:",
             font=("Arial", 11)
         )
         dropdown_label.pack(padx=5, pady=5)
 
-        selected_option = StringVar(add_win)
-        selected_option.set("SmartPlug")
+        self.selected_option = StringVar(self.dialog_win)
+        self.selected_option.set("SmartPlug")
         
         dropdown_menu = OptionMenu(
-            add_win,
-            selected_option,
+            self.dialog_win,
+            self.selected_option,
             "SmartPlug",
             "SmartTV",
             "SmartWashingMachine"
@@ -345,60 +576,60 @@ class SmartHomeApp:
         )
 
         custom_value_label = Label(
-            add_win,
+            self.dialog_win,
             text="Enter custom value:",
             font=("Arial", 11),
         )
         custom_value_label.pack(padx=5, pady=5)
         
-        custom_value_text_var = StringVar(add_win)
-        custom_value_entry = Entry(
-            add_win,
-            textvariable=custom_value_text_var
+        self.custom_value_text_var = StringVar(self.dialog_win)
+        self.custom_value_entry = Entry(
+            self.dialog_win,
+            textvariable=self.custom_value_text_var
         )
-        custom_value_entry.pack(padx=5, pady=5)
-
-        def generate_device_on_ui():
-            value = custom_value_entry.get().strip()
-            device_type = selected_option.get()
-            
-            if value.strip() == "":
-                error_info_label.config(text="Value cannot be empty")
-                return
-            
-            try:
-                device = self.smart_home.input_validation(device_type, value)
-                self.smart_home.add_device(device)
-                
-                add_win.destroy()
-                self.create_widgets()
-
-                if self.update_parent_win:
-                    self.update_parent_win()
-
-            except (ValueError, AttributeError, TypeError) as e:
-                error_info_label.config(text=e)
-                add_win.geometry(f"{len(str(e)) * 8}x200")
+        self.custom_value_entry.pack(padx=5, pady=5)
+        self.custom_value_entry.bind("<Return>", lambda event: self.generate_device_on_ui())
 
         save_button = Button(
-            add_win,
+            self.dialog_win,
             text="Save",
             font=("Arial", 11),
             bg="white",
             bd=1,
-            command=generate_device_on_ui
+            command=self.generate_device_on_ui
         )
         save_button.pack(padx=5, pady=5)
 
-        error_info_label = Label(
-            add_win,
+        self.error_info_label = Label(
+            self.dialog_win,
             fg="red",
             font=("Arial", 11)
         )
-        error_info_label.pack(padx=5, pady=5)
-
-        add_win.mainloop()
+        self.error_info_label.pack(padx=5, pady=5)
+
+    def show(self, modal=False):
+        self.selected_option.set("SmartPlug")
+        self.custom_value_text_var.set("")
+        self.error_info_label.config(text="")
+        self.open(modal)
+        self.custom_value_entry.focus_set()
+
+    def generate_device_on_ui(self):
+        value = self.custom_value_text_var.get().strip()
+        device_type = self.selected_option.get()
+        
+        if value == "":
+            self.error_info_label.config(text="Value cannot be empty")
+            return
+        
+        self.app.record("add_device", device_type, value)
+        try:
+            device = self.app.smart_home.input_validation(device_type, value)
+            self.app.smart_home.add_device(device)
+            self.saved()
 
+        except (ValueError, AttributeError, TypeError) as e:
+            self.show_error(e)
 
 def test_smart_home_system(app):
     try:
@@ -407,9 +638,87 @@ def test_smart_home_system(app):
         print(e)    
 
 
+def count_widgets(widget):
+    count = 1
+    for child in widget.winfo_children():
+        count += count_widgets(child)
+    return count
+
+
+def benchmark_renderers(number_of_devices=500):
+    import time
+    import tracemalloc
+
+    print(f"Rendering a SmartHome with {number_of_devices} devices:")
+    for renderer in ("widgets", "tree"):
+        win = Tk()
+        app = SmartHomeApp(win, renderer=renderer)
+        app.smart_home = SmartHome(max_items=number_of_devices)
+        for i in range(number_of_devices):
+            app.smart_home.add_device(SmartPlug(i % 151))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        app.create_widgets()
+        win.update()
+        first_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        app.create_widgets()
+        win.update()
+        refresh_time = time.perf_counter() - start
+        memory_used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(
+            f"{renderer}: {count_widgets(win)} widgets, first draw {first_time * 1000:.1f}ms, "
+            f"refresh {refresh_time * 1000:.1f}ms, {memory_used / 1024:.0f}KiB Python memory"
+        )
+        win.destroy()
+
+
+def benchmark_dialogs(number_of_cycles=2000):
+    import gc
+    import time
+
+    print(f"Opening and closing the edit dialog {number_of_cycles} times:")
+    for pooled in (False, True):
+        win = Tk()
+        app = SmartHomeApp(win)
+        app.create_widgets()
+        win.update()
+        gc.collect()
+        objects_before = len(gc.get_objects())
+
+        start = time.perf_counter()
+        for i in range(number_of_cycles):
+            if pooled:
+                app.edit_device(i % len(app.smart_home.devices))
+            else:
+                # what every click used to cost, a whole new dialog
+                app.edit_dialog = EditDeviceDialog(app)
+                app.edit_dialog.show(i % len(app.smart_home.devices))
+            win.update()
+            app.edit_dialog.hide()
+            if not pooled:
+                app.edit_dialog.dialog_win.destroy()
+            win.update()
+        elapsed = time.perf_counter() - start
+
+        gc.collect()
+        retained_objects = len(gc.get_objects()) - objects_before
+        print(
+            f"{'pooled' if pooled else 'fresh'}: {elapsed / number_of_cycles * 1000:.2f}ms per open, "
+            f"{retained_objects} objects retained, {count_widgets(win)} widgets"
+        )
+        win.destroy()
+
+
 def main():
     app = SmartHomeApp(win=Tk())
     test_smart_home_system(app)
     app.run()
 
-#main()
\ No newline at end of file
+#main()
+#benchmark_renderers()
+#benchmark_dialogs()
\ No newline at end of file
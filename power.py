@@ -0,0 +1,130 @@
+import time
+
+
+class FleetPowerBudget:
+
+    # keeps a running total of the switched on plug draw over every tracked home, so
+    # checking an action against the fleet cap costs the same whatever the fleet size
+    def __init__(self, fleet_budget):
+        self.fleet_budget = fleet_budget
+        self.current_power = 0
+        self.tracked = {}
+
+    def track(self, smart_home_name, smart_home):
+        self.untrack(smart_home_name)
+
+        def listener(smart_home, event, index, device):
+            self.on_change(smart_home_name, smart_home)
+
+        smart_home.power_guard = self.check
+        smart_home.listeners.append(listener)
+        self.tracked[smart_home_name] = [smart_home, listener, smart_home.current_power]
+        self.current_power += smart_home.current_power
+
+    def track_all(self, smart_homes):
+        for smart_home_name, smart_home in smart_homes:
+            self.track(smart_home_name, smart_home)
+
+    def untrack(self, smart_home_name):
+        if smart_home_name not in self.tracked:
+            return
+
+        smart_home, listener, home_power = self.tracked.pop(smart_home_name)
+        if listener in smart_home.listeners:
+            smart_home.listeners.remove(listener)
+        if smart_home.power_guard == self.check:
+            smart_home.power_guard = None
+        self.current_power -= home_power
+
+    def check(self, smart_home, extra_power):
+        if self.current_power + extra_power > self.fleet_budget:
+            raise ValueError(
+                f"Fleet power budget of {self.fleet_budget}W exceeded: "
+                f"{self.current_power}W in use, {extra_power}W more requested"
+            )
+
+    def on_change(self, smart_home_name, smart_home):
+        entry = self.tracked[smart_home_name]
+        self.current_power += smart_home.current_power - entry[2]
+        entry[2] = smart_home.current_power
+
+    def remaining_power(self):
+        return self.fleet_budget - self.current_power
+
+
+def benchmark_power_budget(number_of_homes=20000, number_of_steps=100000):
+    import random
+    from backend import SmartHome, SmartPlug
+    from fleetgen import FleetGenerator
+
+    smart_homes = list(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+    number_of_devices = sum(len(smart_home.devices) for smart_home_name, smart_home in smart_homes)
+
+    random.seed(1)
+    trace = []
+    for i in range(number_of_steps):
+        smart_home_name, smart_home = random.choice(smart_homes)
+        if smart_home.devices:
+            trace.append((smart_home, random.randrange(len(smart_home.devices))))
+
+    def summed_fleet_power():
+        total = 0
+        for smart_home_name, smart_home in smart_homes:
+            for device in smart_home.devices:
+                if isinstance(device, SmartPlug) and device.switched_on:
+                    total += device.consumption_rate
+        return total
+
+    # the linear way, summing the home before every toggle
+    start = time.perf_counter()
+    for smart_home, index in trace:
+        device = smart_home.devices[index]
+        home_power = sum(
+            other.consumption_rate for other in smart_home.devices
+            if isinstance(other, SmartPlug) and other.switched_on
+        )
+        if isinstance(device, SmartPlug) and not device.switched_on:
+            home_power + device.consumption_rate <= 500
+        device.toggle_switch()
+    summed_time = time.perf_counter() - start
+
+    # summing the whole fleet is what a naive fleet cap would need, so only time a few
+    start = time.perf_counter()
+    for i in range(10):
+        summed_fleet_power()
+    summed_fleet_time = (time.perf_counter() - start) / 10
+
+    for smart_home_name, smart_home in smart_homes:
+        smart_home.recalculate_power()
+        smart_home.power_budget = 1000
+    fleet_budget = FleetPowerBudget(summed_fleet_power() + 50000)
+    fleet_budget.track_all(smart_homes)
+
+    rejected = 0
+    start = time.perf_counter()
+    for smart_home, index in trace:
+        try:
+            smart_home.toggle_device(index)
+        except ValueError:
+            rejected += 1
+    budget_time = time.perf_counter() - start
+
+    shed_home = SmartHome(max_items=5)
+    shed_home.power_policy = "shed"
+    shed_home.power_budget = 200
+    for consumption_rate, priority in ((100, 0), (80, 2), (60, 1)):
+        shed_home.add_device(SmartPlug(consumption_rate))
+        shed_home.set_device_priority(len(shed_home.devices) - 1, priority)
+    shed_home.switch_all_on()
+    shed_home.set_device_priority(0, 3)
+    shed_home.toggle_device(0)
+
+    print(f"Power budget over {number_of_homes} homes with {number_of_devices} devices, {len(trace)} toggles:")
+    print(f"Summing the home per toggle: {summed_time / len(trace) * 1000000:.2f}us per toggle")
+    print(f"Summing the fleet per toggle: {summed_fleet_time * 1000:.2f}ms per toggle")
+    print(f"Running totals with home and fleet caps: {budget_time / len(trace) * 1000000:.2f}us per toggle, {rejected} rejected")
+    print(f"Fleet total matches: {fleet_budget.current_power == summed_fleet_power()}")
+    print(f"Shed policy: {[device.switched_on for device in shed_home.devices]}, {shed_home.current_power}W")
+
+
+#benchmark_power_budget()
@@ -0,0 +1,182 @@
+import csv
+import io
+import json
+import time
+from savefile import open_save_file
+
+
+REPORT_FORMATS = ("plain", "csv", "jsonl")
+REPORT_KINDS = ("devices", "homes")
+
+
+def device_matches(device, device_type=None, switched_on=None):
+    if device_type is not None and type(device).__name__ != device_type:
+        return False
+    if switched_on is not None and device.switched_on != switched_on:
+        return False
+    return True
+
+
+def report_value(device):
+    device_type = type(device).__name__
+    if device_type == "SmartPlug":
+        return device.consumption_rate
+    elif device_type == "SmartTV":
+        return device.channel
+    elif device_type == "SmartWashingMachine":
+        return device.wash_mode
+    return None
+
+
+def iter_device_rows(smart_homes, device_type=None, switched_on=None):
+    for smart_home_name, smart_home in smart_homes:
+        for i, device in enumerate(smart_home.devices):
+            if device_matches(device, device_type, switched_on):
+                yield smart_home_name, i + 1, type(device).__name__, device.switched_on, report_value(device)
+
+
+def home_row(smart_home_name, smart_home, device_type=None, switched_on=None):
+    number_of_devices = 0
+    number_of_devices_currently_on = 0
+    current_load = 0
+
+    for device in smart_home.devices:
+        if not device_matches(device, device_type, switched_on):
+            continue
+        number_of_devices += 1
+        if device.switched_on:
+            number_of_devices_currently_on += 1
+            if type(device).__name__ == "SmartPlug":
+                current_load += device.consumption_rate
+
+    return smart_home_name, smart_home.max_items, number_of_devices, number_of_devices_currently_on, current_load
+
+
+def iter_home_rows(smart_homes, device_type=None, switched_on=None):
+    for smart_home_name, smart_home in smart_homes:
+        yield home_row(smart_home_name, smart_home, device_type, switched_on)
+
+
+def iter_plain_report(smart_homes, kind, device_type=None, switched_on=None):
+    total_homes = 0
+    total_devices = 0
+    total_switched_on = 0
+    total_load = 0
+
+    for smart_home_name, smart_home in smart_homes:
+        smart_home_name, max_items, number_of_devices, number_of_devices_currently_on, current_load = home_row(
+            smart_home_name, smart_home, device_type, switched_on
+        )
+        total_homes += 1
+        total_devices += number_of_devices
+        total_switched_on += number_of_devices_currently_on
+        total_load += current_load
+        yield f"{smart_home_name}: {number_of_devices} devices, {number_of_devices_currently_on} switched on, {current_load}W\n"
+
+        if kind == "devices":
+            for i, device in enumerate(smart_home.devices):
+                if device_matches(device, device_type, switched_on):
+                    yield f"  {i+1}- {device}\n"
+
+    yield f"Fleet: {total_homes} homes, {total_devices} devices, {total_switched_on} switched on, {total_load}W\n"
+
+
+def iter_csv_report(smart_homes, kind, device_type=None, switched_on=None):
+    # rows go through csv.writer into a small reusable buffer, one chunk per row
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+
+    if kind == "devices":
+        writer.writerow(["home", "index", "type", "switched_on", "value"])
+        rows = iter_device_rows(smart_homes, device_type, switched_on)
+    else:
+        writer.writerow(["home", "max_items", "devices", "switched_on", "load"])
+        rows = iter_home_rows(smart_homes, device_type, switched_on)
+
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_jsonl_report(smart_homes, kind, device_type=None, switched_on=None):
+    if kind == "devices":
+        for smart_home_name, index, device_type_found, device_state, value in iter_device_rows(
+            smart_homes, device_type, switched_on
+        ):
+            yield json.dumps({
+                "home": smart_home_name,
+                "index": index,
+                "type": device_type_found,
+                "switched_on": device_state,
+                "value": value,
+            }) + "\n"
+    else:
+        for smart_home_name, max_items, number_of_devices, number_of_devices_currently_on, current_load in iter_home_rows(
+            smart_homes, device_type, switched_on
+        ):
+            yield json.dumps({
+                "home": smart_home_name,
+                "max_items": max_items,
+                "devices": number_of_devices,
+                "switched_on": number_of_devices_currently_on,
+                "load": current_load,
+            }) + "\n"
+
+
+def iter_report(smart_homes, report_format="plain", kind="devices", device_type=None, switched_on=None):
+    # smart_homes is any iterable of (smart_home_name, smart_home) pairs, e.g. iter_csv() or
+    # SQLiteStore.iter_homes(), so only one home has to be in memory at a time
+    if report_format not in REPORT_FORMATS:
+        raise ValueError(f"Report format must be one of: {', '.join(REPORT_FORMATS)}")
+    if kind not in REPORT_KINDS:
+        raise ValueError(f"Report kind must be one of: {', '.join(REPORT_KINDS)}")
+
+    if report_format == "plain":
+        return iter_plain_report(smart_homes, kind, device_type, switched_on)
+    elif report_format == "csv":
+        return iter_csv_report(smart_homes, kind, device_type, switched_on)
+    else:
+        return iter_jsonl_report(smart_homes, kind, device_type, switched_on)
+
+
+def write_report(output, smart_homes, report_format="plain", kind="devices", device_type=None, switched_on=None):
+    # output is a text stream or a file name, file names ending in .gz or .xz are compressed
+    if isinstance(output, str):
+        with open_save_file(output, "w") as file:
+            return write_report(file, smart_homes, report_format, kind, device_type, switched_on)
+
+    characters_written = 0
+    for chunk in iter_report(smart_homes, report_format, kind, device_type, switched_on):
+        output.write(chunk)
+        characters_written += len(chunk)
+    return characters_written
+
+
+def benchmark_reports(number_of_homes=350000):
+    import os
+    import tempfile
+    import tracemalloc
+    from fleetgen import FleetGenerator
+
+    generator = FleetGenerator(seed=1, devices_per_home=(2, 4))
+    directory = tempfile.mkdtemp()
+    print(f"Streaming reports for {number_of_homes} generated homes (about {number_of_homes * 3} devices):")
+
+    for report_format in REPORT_FORMATS:
+        file_name = os.path.join(directory, f"report.{report_format}")
+        tracemalloc.start()
+        start = time.perf_counter()
+        characters_written = write_report(file_name, generator.generate_fleet(number_of_homes), report_format)
+        elapsed = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            f"{report_format}: {characters_written / 1024 / 1024:.1f}MiB in {elapsed:.2f}s, "
+            f"peak Python memory {peak_memory / 1024:.0f}KiB"
+        )
+
+
+#benchmark_reports()
@@ -0,0 +1,311 @@
+import gzip
+import lzma
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from backend import SmartPlug, SmartTV, SmartWashingMachine, SmartHome, SparseSmartHome
+
+
+DEVICE_CLASSES = {
+    "SmartPlug": SmartPlug,
+    "SmartTV": SmartTV,
+    "SmartWashingMachine": SmartWashingMachine,
+}
+
+
+def device_value(device):
+    device_type = type(device).__name__
+
+    if device_type == "SmartPlug":
+        return str(device.consumption_rate)
+    elif device_type == "SmartTV":
+        return str(device.channel)
+    elif device_type == "SmartWashingMachine":
+        return device.wash_mode
+    else:
+        raise ValueError(f"Unknown device type: {device_type}")
+
+
+def create_device(device_type, device_state, device_value):
+    if device_type == "SmartPlug":
+        device = SmartPlug(int(device_value))
+    elif device_type == "SmartTV":
+        device = SmartTV()
+        device.channel = int(device_value)
+    elif device_type == "SmartWashingMachine":
+        device = SmartWashingMachine()
+        device.wash_mode = device_value
+    else:
+        raise ValueError(f"Unknown device type: {device_type}")
+
+    device.switched_on = device_state
+    return device
+
+
+def iter_device_slots(smart_home):
+    # device objects, or the device class for devices a SparseSmartHome keeps at defaults
+    if isinstance(smart_home, SparseSmartHome):
+        return iter(smart_home.slots)
+    return iter(smart_home.devices)
+
+
+def smart_home_to_csv_line(smart_home_name, smart_home, sparse=False):
+    # sparse lines write a run of default devices as one "SmartTV*3" field instead of
+    # a type, state and value for each of them
+    values = [smart_home_name, str(smart_home.max_items)]
+    default_type = None
+    default_count = 0
+
+    for slot in iter_device_slots(smart_home):
+        if sparse and (isinstance(slot, type) or slot.is_default()):
+            device_type = slot.__name__ if isinstance(slot, type) else type(slot).__name__
+            if device_type != default_type and default_count:
+                values.append(f"{default_type}*{default_count}")
+                default_count = 0
+            default_type = device_type
+            default_count += 1
+            continue
+
+        if default_count:
+            values.append(f"{default_type}*{default_count}")
+            default_count = 0
+
+        device = slot() if isinstance(slot, type) else slot
+        values.append(type(device).__name__)
+        values.append(str(device.switched_on))
+        values.append(device_value(device))
+
+    if default_count:
+        values.append(f"{default_type}*{default_count}")
+
+    return ",".join(values) + "\n"
+
+
+def iter_csv_fields(smart_home_data):
+    # yields (device_type, device_state, device_value), with None state and value for a default device
+    i = 2
+    while i < len(smart_home_data):
+        if "*" in smart_home_data[i]:
+            device_type, count = smart_home_data[i].split("*")
+            for j in range(int(count)):
+                yield device_type, None, None
+            i += 1
+        elif i + 2 < len(smart_home_data):
+            yield smart_home_data[i], smart_home_data[i+1] == "True", smart_home_data[i+2]
+            i += 3
+        else:
+            break
+
+
+def add_parsed_device(smart_home, device_type, device_state, device_value):
+    if device_state is not None:
+        smart_home.add_device(create_device(device_type, device_state, device_value))
+    elif device_type not in DEVICE_CLASSES:
+        raise ValueError(f"Unknown device type: {device_type}")
+    elif isinstance(smart_home, SparseSmartHome):
+        smart_home.add_default_device(DEVICE_CLASSES[device_type])
+    else:
+        smart_home.add_device(DEVICE_CLASSES[device_type]())
+
+
+def smart_home_from_csv_line(line, sparse=False):
+    smart_home_data = line.strip().split(",")
+    smart_home_name = smart_home_data[0]
+    smart_home = SparseSmartHome(int(smart_home_data[1])) if sparse else SmartHome(int(smart_home_data[1]))
+
+    for device_type, device_state, device_value in iter_csv_fields(smart_home_data):
+        add_parsed_device(smart_home, device_type, device_state, device_value)
+
+    return smart_home_name, smart_home
+
+
+def compression_for(file_name):
+    if file_name.endswith(".gz"):
+        return "gzip"
+    elif file_name.endswith(".xz") or file_name.endswith(".lzma"):
+        return "lzma"
+    return None
+
+
+def open_save_file(file_name, mode, compression=None, level=None):
+    # text-mode file object, compressed saves are written and read as a stream
+    if compression is None:
+        compression = compression_for(file_name)
+
+    if compression == "gzip":
+        if "w" in mode:
+            return gzip.open(file_name, mode + "t", compresslevel=6 if level is None else level)
+        return gzip.open(file_name, mode + "t")
+    elif compression == "lzma":
+        if "w" in mode:
+            return lzma.open(file_name, mode + "t", preset=level)
+        return lzma.open(file_name, mode + "t")
+    elif compression is None:
+        return open(file_name, mode)
+    else:
+        raise ValueError(f"Unknown compression: {compression}")
+
+
+def save_csv(file_name, smart_homes, compression=None, level=None, sparse=False):
+    # smart_homes is an iterable of (smart_home_name, smart_home) pairs
+    with open_save_file(file_name, "w", compression, level) as file:
+        for smart_home_name, smart_home in smart_homes:
+            file.write(smart_home_to_csv_line(smart_home_name, smart_home, sparse))
+
+
+def iter_csv(file_name, compression=None, sparse=False):
+    # reads dense and sparse saves alike, sparse decides which SmartHome class is built
+    with open_save_file(file_name, "r", compression) as file:
+        for line in file:
+            if line.strip():
+                yield smart_home_from_csv_line(line, sparse)
+
+
+def load_csv(file_name, sparse=False):
+    return dict(iter_csv(file_name, sparse=sparse))
+
+
+def smart_home_id(smart_home_name):
+    try:
+        return int(smart_home_name.split()[-1])
+    except (ValueError, IndexError):
+        return 0
+
+
+# parallel loading: the file is cut at line boundaries into byte ranges, worker processes
+# parse the ranges into compact records and the parent builds the SmartHomes in file order
+
+def parse_csv_record(line):
+    smart_home_data = line.strip().split(",")
+    devices = []
+
+    for device_type, device_state, device_value in iter_csv_fields(smart_home_data):
+        if device_value is not None and device_type != "SmartWashingMachine":
+            device_value = int(device_value)
+        devices.append((device_type, device_state, device_value))
+
+    return smart_home_data[0], int(smart_home_data[1]), devices
+
+
+def smart_home_from_record(record, sparse=False):
+    smart_home_name, max_items, devices = record
+    smart_home = SparseSmartHome(max_items) if sparse else SmartHome(max_items)
+    for device_type, device_state, device_value in devices:
+        add_parsed_device(smart_home, device_type, device_state, device_value)
+    return smart_home_name, smart_home
+
+
+def split_file(file_name, number_of_ranges):
+    file_size = os.path.getsize(file_name)
+    boundaries = [0]
+
+    with open(file_name, "rb") as file:
+        for k in range(1, number_of_ranges):
+            file.seek(max(k * file_size // number_of_ranges, boundaries[-1]))
+            if file.tell() > 0:
+                file.readline()
+            position = min(file.tell(), file_size)
+            if position > boundaries[-1]:
+                boundaries.append(position)
+
+    if boundaries[-1] < file_size:
+        boundaries.append(file_size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def parse_file_range(file_range):
+    file_name, start, end = file_range
+    with open(file_name, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+
+    return [parse_csv_record(line) for line in data.decode().splitlines() if line.strip()]
+
+
+def iter_csv_parallel(file_name, workers=None, sparse=False):
+    workers = workers or os.cpu_count() or 1
+    file_ranges = [(file_name, start, end) for start, end in split_file(file_name, workers * 4)]
+
+    # spawned rather than forked, a fork of the Tk process could copy a lock the autosave
+    # thread was holding into every worker
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for records in executor.map(parse_file_range, file_ranges):
+            for record in records:
+                yield smart_home_from_record(record, sparse)
+
+
+def load_csv_parallel(file_name, workers=None, sparse=False):
+    return dict(iter_csv_parallel(file_name, workers, sparse))
+
+
+def benchmark_parallel_load(number_of_homes=200000):
+    import tempfile
+    import time
+    from fleetgen import FleetGenerator
+
+    smart_homes = list(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+
+    file_name = os.path.join(tempfile.mkdtemp(), "state.csv")
+    save_csv(file_name, smart_homes)
+    del smart_homes
+
+    print(f"Loading {number_of_homes} homes ({os.path.getsize(file_name) / 1024 / 1024:.1f}MiB):")
+
+    start = time.perf_counter()
+    expected = load_csv(file_name)
+    print(f"Single process: {time.perf_counter() - start:.3f}s")
+
+    for workers in (1, 2, 4, 8):
+        start = time.perf_counter()
+        loaded = load_csv_parallel(file_name, workers)
+        elapsed = time.perf_counter() - start
+        same_order = list(loaded) == list(expected)
+        print(f"{workers} workers: {elapsed:.3f}s, same order: {same_order}")
+
+
+#benchmark_parallel_load()
+
+
+def benchmark_compression(number_of_homes=200000):
+    import tempfile
+    import time
+    from fleetgen import FleetGenerator
+
+    smart_homes = list(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+
+    directory = tempfile.mkdtemp()
+    plain_size = None
+
+    print(f"Saving and loading {number_of_homes} homes:")
+    for compression, level, extension in (
+        (None, None, ".csv"),
+        ("gzip", 1, ".csv.gz"),
+        ("gzip", 6, ".csv.gz"),
+        ("gzip", 9, ".csv.gz"),
+        ("lzma", 0, ".csv.xz"),
+        ("lzma", 6, ".csv.xz"),
+    ):
+        file_name = os.path.join(directory, f"state-{level}{extension}")
+
+        start = time.perf_counter()
+        save_csv(file_name, smart_homes, compression, level)
+        save_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for smart_home_name, smart_home in iter_csv(file_name):
+            pass
+        load_time = time.perf_counter() - start
+
+        file_size = os.path.getsize(file_name)
+        if plain_size is None:
+            plain_size = file_size
+        megabytes = plain_size / 1024 / 1024
+
+        print(
+            f"{compression or 'plain'} level {level}: {file_size / 1024:.0f}KiB, "
+            f"ratio {plain_size / file_size:.1f}x, save {megabytes / save_time:.1f}MiB/s, "
+            f"load {megabytes / load_time:.1f}MiB/s"
+        )
+
+
+#benchmark_compression()
@@ -0,0 +1,415 @@
+import json
+import os
+from collections import deque
+import socket
+import struct
+import time
+import zlib
+from multiprocessing import Process
+from backend import SmartPlug
+from savefile import device_value, smart_home_from_record
+
+
+# Every message is a frame: FRAME_FORMAT header (length of the body, code) then a JSON
+# body. Requests carry an operation code and a list of arguments, responses carry
+# STATUS_OK and the result, or STATUS_ERROR and [exception name, message]. A connection
+# answers its requests in order, so the coordinator can pipeline requests and match the
+# responses up by position. It keeps at most a window of unanswered requests per shard
+# and reads the oldest response before sending more: a shard that can't write its
+# responses stops reading requests, so sending a whole batch first can deadlock once
+# both socket buffers are full.
+FRAME_FORMAT = "<IB"
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+
+OPERATIONS = (
+    "load_homes",
+    "add_home",
+    "remove_home",
+    "get_home",
+    "home_names",
+    "add_device",
+    "remove_device",
+    "toggle_device",
+    "update_option",
+    "switch_all_on",
+    "switch_all_off",
+    "aggregate",
+    "shutdown",
+)
+OPERATION_CODES = {operation: code for code, operation in enumerate(OPERATIONS)}
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+ERROR_TYPES = {"ValueError": ValueError, "TypeError": TypeError, "IndexError": IndexError, "KeyError": KeyError}
+
+
+def send_frame(connection, code, body):
+    data = json.dumps(body, separators=(",", ":")).encode()
+    connection.sendall(struct.pack(FRAME_FORMAT, len(data), code) + data)
+
+
+def receive_exactly(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    return data
+
+
+def receive_frame(file):
+    header = file.read(FRAME_SIZE)
+    if not header:
+        return None, None
+    if len(header) != FRAME_SIZE:
+        raise ConnectionError("Connection closed in the middle of a frame")
+    length, code = struct.unpack(FRAME_FORMAT, header)
+    return code, json.loads(receive_exactly(file, length))
+
+
+def home_record(smart_home_name, smart_home):
+    return [
+        smart_home_name,
+        smart_home.max_items,
+        [[type(device).__name__, device.switched_on, device_value(device)] for device in smart_home.devices],
+    ]
+
+
+def shard_for(smart_home_name, number_of_shards):
+    # crc32 instead of hash(), which is salted per process
+    return zlib.crc32(smart_home_name.encode()) % number_of_shards
+
+
+def parse_address(address):
+    # "unix:/path/to/socket" or "host:port"
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[5:]
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+
+class ShardWorker:
+
+    # owns the homes of one shard and answers requests from a coordinator
+    def __init__(self, address):
+        self.address = address
+        self.smart_homes_dict = {}
+        self.running = True
+
+    def load_homes(self, records):
+        for record in records:
+            smart_home_name, smart_home = smart_home_from_record(record)
+            self.smart_homes_dict[smart_home_name] = smart_home
+        return len(self.smart_homes_dict)
+
+    def add_home(self, record):
+        if record[0] in self.smart_homes_dict:
+            raise ValueError(f"Smart home already exists: {record[0]}")
+        smart_home_name, smart_home = smart_home_from_record(record)
+        self.smart_homes_dict[smart_home_name] = smart_home
+
+    def remove_home(self, smart_home_name):
+        del self.smart_homes_dict[smart_home_name]
+
+    def get_home(self, smart_home_name):
+        return home_record(smart_home_name, self.smart_homes_dict[smart_home_name])
+
+    def home_names(self):
+        return list(self.smart_homes_dict)
+
+    def add_device(self, smart_home_name, device_type, value):
+        smart_home = self.smart_homes_dict[smart_home_name]
+        smart_home.add_device(smart_home.input_validation(device_type, str(value)))
+
+    def remove_device(self, smart_home_name, index):
+        self.smart_homes_dict[smart_home_name].remove_device(index)
+
+    def toggle_device(self, smart_home_name, index):
+        smart_home = self.smart_homes_dict[smart_home_name]
+        smart_home.toggle_device(index)
+        return smart_home.get_device(index).switched_on
+
+    def update_option(self, smart_home_name, index, value):
+        self.smart_homes_dict[smart_home_name].update_option(index, value)
+
+    def switch_all_on(self, smart_home_name):
+        self.smart_homes_dict[smart_home_name].switch_all_on()
+
+    def switch_all_off(self, smart_home_name):
+        self.smart_homes_dict[smart_home_name].switch_all_off()
+
+    def aggregate(self):
+        number_of_devices = 0
+        number_of_devices_currently_on = 0
+        current_load = 0
+
+        for smart_home in self.smart_homes_dict.values():
+            for device in smart_home.devices:
+                number_of_devices += 1
+                if device.switched_on:
+                    number_of_devices_currently_on += 1
+                    if isinstance(device, SmartPlug):
+                        current_load += device.consumption_rate
+
+        return [len(self.smart_homes_dict), number_of_devices, number_of_devices_currently_on, current_load]
+
+    def shutdown(self):
+        self.running = False
+
+    def handle(self, connection):
+        file = connection.makefile("rb")
+        while self.running:
+            code, arguments = receive_frame(file)
+            if code is None:
+                break
+
+            try:
+                result = getattr(self, OPERATIONS[code])(*arguments)
+                send_frame(connection, STATUS_OK, result)
+            except (ValueError, TypeError, IndexError, KeyError) as e:
+                send_frame(connection, STATUS_ERROR, [type(e).__name__, str(e)])
+        file.close()
+
+    def serve(self):
+        family, bind_address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(bind_address):
+            os.remove(bind_address)
+
+        server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(bind_address)
+        server.listen()
+
+        while self.running:
+            connection, client_address = server.accept()
+            if family == socket.AF_INET:
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with connection:
+                self.handle(connection)
+
+        server.close()
+        if family == socket.AF_UNIX:
+            os.remove(bind_address)
+
+
+def run_shard_worker(address):
+    ShardWorker(address).serve()
+
+
+class ShardConnection:
+
+    def __init__(self, address, timeout=10):
+        family, connect_address = parse_address(address)
+        deadline = time.monotonic() + timeout
+
+        # the worker may still be starting up
+        while True:
+            try:
+                self.socket = socket.socket(family, socket.SOCK_STREAM)
+                self.socket.connect(connect_address)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.socket.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+
+        if family == socket.AF_INET:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.socket.makefile("rb")
+
+    def send(self, operation, *arguments):
+        send_frame(self.socket, OPERATION_CODES[operation], arguments)
+
+    def receive(self):
+        status, result = receive_frame(self.file)
+        if status is None:
+            raise ConnectionError("Shard closed the connection")
+        if status == STATUS_ERROR:
+            error_type, message = result
+            raise ERROR_TYPES.get(error_type, RuntimeError)(message)
+        return result
+
+    def request(self, operation, *arguments):
+        self.send(operation, *arguments)
+        return self.receive()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+class ShardedFleet:
+
+    # coordinator: home level operations go to the shard that owns the home, fleet
+    # aggregates are scattered to every shard and the answers gathered back. It is used
+    # directly by scripts and services, SmartHomesApp still keeps its homes in one process.
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.shards = [ShardConnection(address) for address in self.addresses]
+
+    def shard(self, smart_home_name):
+        return self.shards[shard_for(smart_home_name, len(self.shards))]
+
+    def load_homes(self, smart_homes, batch_size=5000):
+        # smart_homes is any iterable of (smart_home_name, smart_home) pairs
+        batches = [[] for shard in self.shards]
+
+        def send_batch(i):
+            self.shards[i].send("load_homes", batches[i])
+            self.shards[i].receive()
+            batches[i] = []
+
+        for smart_home_name, smart_home in smart_homes:
+            i = shard_for(smart_home_name, len(self.shards))
+            batches[i].append(home_record(smart_home_name, smart_home))
+            if len(batches[i]) >= batch_size:
+                send_batch(i)
+
+        for i in range(len(self.shards)):
+            if batches[i]:
+                send_batch(i)
+
+    def add_home(self, smart_home_name, smart_home):
+        self.shard(smart_home_name).request("add_home", home_record(smart_home_name, smart_home))
+
+    def remove_home(self, smart_home_name):
+        self.shard(smart_home_name).request("remove_home", smart_home_name)
+
+    def get_home(self, smart_home_name):
+        return smart_home_from_record(self.shard(smart_home_name).request("get_home", smart_home_name))[1]
+
+    def add_device(self, smart_home_name, device_type, value):
+        self.shard(smart_home_name).request("add_device", smart_home_name, device_type, value)
+
+    def remove_device(self, smart_home_name, index):
+        self.shard(smart_home_name).request("remove_device", smart_home_name, index)
+
+    def toggle_device(self, smart_home_name, index):
+        return self.shard(smart_home_name).request("toggle_device", smart_home_name, index)
+
+    def update_option(self, smart_home_name, index, value):
+        self.shard(smart_home_name).request("update_option", smart_home_name, index, value)
+
+    def switch_all_on(self, smart_home_name):
+        self.shard(smart_home_name).request("switch_all_on", smart_home_name)
+
+    def switch_all_off(self, smart_home_name):
+        self.shard(smart_home_name).request("switch_all_off", smart_home_name)
+
+    def execute_batch(self, operations, window=64):
+        # operations is a list of (operation, smart_home_name, *arguments), results come back
+        # in batch order. Up to window requests per shard are in flight before the oldest
+        # answer is read, so neither side can block on a socket buffer full of the other's
+        # unread frames however long the batch is.
+        outstanding = [deque() for shard in self.shards]
+        results = [None] * len(operations)
+
+        def receive_oldest(i):
+            position = outstanding[i].popleft()
+            try:
+                results[position] = self.shards[i].receive()
+            except (ValueError, TypeError, IndexError, KeyError) as e:
+                results[position] = e
+
+        for position, (operation, smart_home_name, *arguments) in enumerate(operations):
+            i = shard_for(smart_home_name, len(self.shards))
+            if len(outstanding[i]) >= window:
+                receive_oldest(i)
+            self.shards[i].send(operation, smart_home_name, *arguments)
+            outstanding[i].append(position)
+
+        for i in range(len(self.shards)):
+            while outstanding[i]:
+                receive_oldest(i)
+        return results
+
+    def scatter_gather(self, operation, *arguments):
+        for shard in self.shards:
+            shard.send(operation, *arguments)
+        return [shard.receive() for shard in self.shards]
+
+    def home_names(self):
+        smart_home_names = []
+        for shard_names in self.scatter_gather("home_names"):
+            smart_home_names.extend(shard_names)
+        return smart_home_names
+
+    def aggregate(self):
+        totals = [0, 0, 0, 0]
+        for shard_totals in self.scatter_gather("aggregate"):
+            totals = [total + shard_total for total, shard_total in zip(totals, shard_totals)]
+
+        number_of_homes, number_of_devices, number_of_devices_currently_on, current_load = totals
+        return {
+            "homes": number_of_homes,
+            "devices": number_of_devices,
+            "switched_on": number_of_devices_currently_on,
+            "load": current_load,
+        }
+
+    def close(self, shutdown=False):
+        if shutdown:
+            self.scatter_gather("shutdown")
+        for shard in self.shards:
+            shard.close()
+
+
+def start_local_shards(number_of_shards, directory=None, use_tcp=False, first_port=47000):
+    # one worker process per shard on this machine, workers elsewhere only need an address
+    if directory is None:
+        import tempfile
+        directory = tempfile.mkdtemp()
+
+    addresses = []
+    processes = []
+    for i in range(number_of_shards):
+        if use_tcp:
+            address = f"127.0.0.1:{first_port + i}"
+        else:
+            address = f"unix:{os.path.join(directory, f'shard-{i}.sock')}"
+        process = Process(target=run_shard_worker, args=(address,), daemon=True)
+        process.start()
+        addresses.append(address)
+        processes.append(process)
+    return addresses, processes
+
+
+def benchmark_sharding(number_of_homes=100000, number_of_steps=50000, max_shards=4, batch_size=500):
+    import random
+    from fleetgen import FleetGenerator
+
+    smart_homes = list(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+    names = [smart_home_name for smart_home_name, smart_home in smart_homes]
+
+    random.seed(1)
+    trace = [("toggle_device", random.choice(names), 0) for i in range(number_of_steps)]
+
+    print(f"Sharded fleet of {number_of_homes} homes, {number_of_steps} toggles in batches of {batch_size}:")
+    for number_of_shards in range(1, max_shards + 1):
+        addresses, processes = start_local_shards(number_of_shards)
+        sharded_fleet = ShardedFleet(addresses)
+
+        start = time.perf_counter()
+        sharded_fleet.load_homes(smart_homes)
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(0, len(trace), batch_size):
+            sharded_fleet.execute_batch(trace[i:i + batch_size])
+        toggle_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        totals = sharded_fleet.aggregate()
+        aggregate_time = time.perf_counter() - start
+
+        sharded_fleet.close(shutdown=True)
+        for process in processes:
+            process.join()
+
+        print(
+            f"{number_of_shards} shards: load {load_time:.2f}s, "
+            f"{number_of_steps / toggle_time:.0f} toggles/s, aggregate {aggregate_time * 1000:.1f}ms, {totals}"
+        )
+
+
+#benchmark_sharding()
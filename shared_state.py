@@ -0,0 +1,340 @@
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+from backend import SmartPlug, SmartTV, SmartWashingMachine
+
+
+# Layout of the segment, all little-endian:
+#
+#   header    HEADER_FORMAT: magic b"SHMF", layout version, sequence, number of homes,
+#             number of devices, home capacity, device capacity
+#   homes     home capacity x HOME_FORMAT: name (utf-8, zero padded), max_items,
+#             device count, index of the home's first device record
+#   devices   device capacity x DEVICE_FORMAT: type code, switched_on, value
+#
+# The value is the consumption rate for a SmartPlug, the channel for a SmartTV and the
+# index into SmartWashingMachine.wash_modes for a SmartWashingMachine. The sequence is a
+# seqlock: the writer makes it odd before changing anything and even again afterwards,
+# so a reader whose sequence is even and unchanged across a read saw a consistent state.
+
+MAGIC = b"SHMF"
+LAYOUT_VERSION = 1
+HEADER_FORMAT = "<4sHxxQIIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SEQUENCE_OFFSET = 8
+HOME_NAME_SIZE = 32
+HOME_FORMAT = f"<{HOME_NAME_SIZE}sHHI"
+HOME_SIZE = struct.calcsize(HOME_FORMAT)
+DEVICE_FORMAT = "<BBH"
+DEVICE_SIZE = struct.calcsize(DEVICE_FORMAT)
+
+def segment_size(home_capacity, device_capacity):
+    return HEADER_SIZE + home_capacity * HOME_SIZE + device_capacity * DEVICE_SIZE
+
+
+def device_record(device):
+    if isinstance(device, SmartPlug):
+        value = device.consumption_rate
+    elif isinstance(device, SmartTV):
+        value = device.channel
+    elif isinstance(device, SmartWashingMachine):
+        value = device.wash_mode_code
+    else:
+        raise ValueError("Must be an object that inherits SmartDevice")
+    return device.type_code, int(device.switched_on), value
+
+
+def pack_device_records(devices):
+    # packed before the sequence goes odd, so a value that doesn't fit never leaves a write open
+    try:
+        return b"".join(struct.pack(DEVICE_FORMAT, *device_record(device)) for device in devices)
+    except struct.error as e:
+        raise ValueError(f"Device does not fit into a shared memory record: {e}")
+
+
+class FleetPublisher:
+
+    def __init__(self, name=None, home_capacity=100000, device_capacity=500000):
+        self.home_capacity = home_capacity
+        self.device_capacity = device_capacity
+        self.shared_memory = shared_memory.SharedMemory(
+            name=name,
+            create=True,
+            size=segment_size(home_capacity, device_capacity)
+        )
+        self.name = self.shared_memory.name
+        self.buffer = self.shared_memory.buf
+        self.sequence = 0
+        self.homes_offset = HEADER_SIZE
+        self.devices_offset = HEADER_SIZE + home_capacity * HOME_SIZE
+
+        # smart_home_name -> (index of the home, index of its first device record)
+        self.positions = {}
+        self.tracked = {}
+        self.smart_homes = []
+
+        # set when a change could not be published because the fleet outgrew the segment,
+        # the segment keeps the last state that fitted until publish() succeeds again
+        self.publish_error = None
+        self.write_header(0, 0)
+
+    def write_header(self, number_of_homes, number_of_devices):
+        struct.pack_into(
+            HEADER_FORMAT, self.buffer, 0,
+            MAGIC, LAYOUT_VERSION, self.sequence, number_of_homes, number_of_devices,
+            self.home_capacity, self.device_capacity
+        )
+
+    def begin_write(self):
+        self.sequence += 1
+        struct.pack_into("<Q", self.buffer, SEQUENCE_OFFSET, self.sequence)
+
+    def end_write(self):
+        self.sequence += 1
+        struct.pack_into("<Q", self.buffer, SEQUENCE_OFFSET, self.sequence)
+
+    def publish(self, smart_homes):
+        # smart_homes is a list of (smart_home_name, smart_home) pairs
+        smart_homes = list(smart_homes)
+        number_of_devices = sum(len(smart_home.devices) for smart_home_name, smart_home in smart_homes)
+        if len(smart_homes) > self.home_capacity or number_of_devices > self.device_capacity:
+            raise ValueError("Fleet does not fit into the shared memory segment")
+
+        # names are cut nowhere, a cut name could collide with another or split a character
+        encoded_names = [smart_home_name.encode() for smart_home_name, smart_home in smart_homes]
+        for encoded_name in encoded_names:
+            if len(encoded_name) > HOME_NAME_SIZE:
+                raise ValueError(f"Smart home name is longer than {HOME_NAME_SIZE} bytes: {encoded_name.decode()}")
+
+        # every record is packed and checked first, the segment is only touched once all of them fit
+        positions = {}
+        home_records = []
+        device_records = []
+        device_index = 0
+        for home_index, (smart_home_name, smart_home) in enumerate(smart_homes):
+            records = pack_device_records(smart_home.devices)
+            number_of_home_devices = len(records) // DEVICE_SIZE
+            try:
+                home_records.append(struct.pack(
+                    HOME_FORMAT, encoded_names[home_index], smart_home.max_items,
+                    number_of_home_devices, device_index
+                ))
+            except struct.error as e:
+                raise ValueError(f"Smart home does not fit into a shared memory record: {smart_home_name}: {e}")
+            device_records.append(records)
+            positions[smart_home_name] = (home_index, device_index)
+            device_index += number_of_home_devices
+        home_records = b"".join(home_records)
+        device_records = b"".join(device_records)
+
+        self.smart_homes = smart_homes
+        self.positions = positions
+        self.publish_error = None
+
+        self.begin_write()
+        try:
+            self.buffer[self.homes_offset:self.homes_offset + len(home_records)] = home_records
+            self.buffer[self.devices_offset:self.devices_offset + len(device_records)] = device_records
+            struct.pack_into("<II", self.buffer, SEQUENCE_OFFSET + 8, len(smart_homes), device_index)
+        finally:
+            self.end_write()
+
+    def track(self, smart_homes):
+        # publish once, then keep the segment in step with every change to the homes
+        self.untrack()
+        self.publish(smart_homes)
+
+        for smart_home_name, smart_home in self.smart_homes:
+            def listener(smart_home, event, index, device, smart_home_name=smart_home_name):
+                self.on_change(smart_home_name, smart_home, event, index, device)
+
+            smart_home.listeners.append(listener)
+            self.tracked[smart_home_name] = (smart_home, listener)
+
+    def untrack(self):
+        for smart_home, listener in self.tracked.values():
+            if listener in smart_home.listeners:
+                smart_home.listeners.remove(listener)
+        self.tracked = {}
+
+    def on_change(self, smart_home_name, smart_home, event, index, device):
+        home_index, first_device_index = self.positions[smart_home_name]
+
+        if self.publish_error is not None:
+            # the positions no longer match the homes, only a whole publish can catch up
+            event = "republish"
+
+        # The home has already changed by now, so anything that can't be published is recorded
+        # instead of raised out of the SmartHome method and past the listeners after this one.
+        try:
+            if event == "update":
+                self.write_device_records(first_device_index + index, pack_device_records([device]))
+            elif event == "update_all":
+                self.write_device_records(first_device_index, pack_device_records(smart_home.devices))
+            else:
+                # adds and removes move every later device record, so the whole fleet is rewritten
+                self.publish(self.smart_homes)
+        except ValueError as e:
+            self.publish_error = str(e)
+
+    def write_device_records(self, device_index, records):
+        offset = self.devices_offset + device_index * DEVICE_SIZE
+        self.begin_write()
+        try:
+            self.buffer[offset:offset + len(records)] = records
+        finally:
+            self.end_write()
+
+    def close(self, unlink=True):
+        self.untrack()
+        self.buffer = None
+        self.shared_memory.close()
+        if unlink:
+            self.shared_memory.unlink()
+
+
+class FleetReader:
+
+    def __init__(self, name, child_of_publisher=False):
+        self.shared_memory = shared_memory.SharedMemory(name=name)
+        # the publisher owns the segment, so a separate process's resource tracker must not remove
+        # it at exit, child processes of the publisher share its tracker and leave it alone
+        if not child_of_publisher:
+            resource_tracker.unregister(self.shared_memory._name, "shared_memory")
+        self.buffer = self.shared_memory.buf
+
+        magic, layout_version, sequence, number_of_homes, number_of_devices, home_capacity, device_capacity = (
+            struct.unpack_from(HEADER_FORMAT, self.buffer, 0)
+        )
+        if magic != MAGIC or layout_version != LAYOUT_VERSION:
+            raise ValueError("Not a fleet shared memory segment")
+
+        self.homes_offset = HEADER_SIZE
+        self.devices_offset = HEADER_SIZE + home_capacity * HOME_SIZE
+        self.device_capacity = device_capacity
+
+    def sequence(self):
+        return struct.unpack_from("<Q", self.buffer, SEQUENCE_OFFSET)[0]
+
+    def counts(self):
+        return struct.unpack_from("<II", self.buffer, SEQUENCE_OFFSET + 8)
+
+    def device_view(self):
+        # zero-copy view of the device records, DEVICE_SIZE bytes each
+        number_of_homes, number_of_devices = self.counts()
+        return self.buffer[self.devices_offset:self.devices_offset + number_of_devices * DEVICE_SIZE]
+
+    def read_consistent(self, read_function, retry_delay=0.0001, timeout=1.0):
+        # run read_function(self) until it sees a state that no write overlapped, a read that
+        # overlapped a write may also fail on half written records, which is retried the same way.
+        # A publisher that died part way through a write leaves the sequence odd for good, so
+        # the retries give up after timeout seconds.
+        deadline = time.monotonic() + timeout
+        while True:
+            sequence = self.sequence()
+            if sequence % 2 == 0:
+                try:
+                    result = read_function(self)
+                except (struct.error, UnicodeDecodeError, IndexError, ValueError):
+                    if self.sequence() == sequence:
+                        raise
+                else:
+                    if self.sequence() == sequence:
+                        return result
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"No consistent read of the shared memory segment within {timeout}s")
+            time.sleep(retry_delay)
+
+    def iter_homes(self):
+        number_of_homes, number_of_devices = self.counts()
+        for home_index in range(number_of_homes):
+            name, max_items, device_count, first_device_index = struct.unpack_from(
+                HOME_FORMAT, self.buffer, self.homes_offset + home_index * HOME_SIZE
+            )
+            devices = [
+                struct.unpack_from(DEVICE_FORMAT, self.buffer, self.devices_offset + i * DEVICE_SIZE)
+                for i in range(first_device_index, first_device_index + device_count)
+            ]
+            yield name.rstrip(b"\0").decode(), max_items, devices
+
+    def snapshot(self):
+        return self.read_consistent(lambda reader: list(reader.iter_homes()))
+
+    def count_switched_on(self, type_code=None):
+        def count(reader):
+            device_view = reader.device_view()
+            total = 0
+            for type_code_found, switched_on, value in struct.iter_unpack(DEVICE_FORMAT, device_view):
+                if switched_on and (type_code is None or type_code_found == type_code):
+                    total += 1
+            device_view.release()
+            return total
+        return self.read_consistent(count)
+
+    def total_load(self):
+        def total(reader):
+            device_view = reader.device_view()
+            load = 0
+            for type_code, switched_on, value in struct.iter_unpack(DEVICE_FORMAT, device_view):
+                if switched_on and type_code == SmartPlug.type_code:
+                    load += value
+            device_view.release()
+            return load
+        return self.read_consistent(total)
+
+    def close(self):
+        self.buffer = None
+        self.shared_memory.close()
+
+
+def read_total_load(name, child_of_publisher=False):
+    reader = FleetReader(name, child_of_publisher)
+    load = reader.total_load()
+    reader.close()
+    return load
+
+
+def benchmark_shared_state(number_of_homes=100000):
+    import os
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from fleetgen import FleetGenerator
+    from savefile import save_csv, load_csv
+    from analytics import home_contribution
+
+    smart_homes = list(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+    number_of_devices = sum(len(smart_home.devices) for smart_home_name, smart_home in smart_homes)
+    expected_load = sum(home_contribution(smart_home)[0] for smart_home_name, smart_home in smart_homes)
+
+    publisher = FleetPublisher(home_capacity=number_of_homes, device_capacity=number_of_devices + 1000)
+    start = time.perf_counter()
+    publisher.track(smart_homes)
+    publish_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for smart_home_name, smart_home in smart_homes[:10000]:
+        smart_home.switch_all_off()
+    update_time = (time.perf_counter() - start) / 10000
+    expected_load = sum(home_contribution(smart_home)[0] for smart_home_name, smart_home in smart_homes)
+
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        executor.submit(read_total_load, publisher.name, True).result()
+        start = time.perf_counter()
+        shared_load = executor.submit(read_total_load, publisher.name, True).result()
+        shared_read_time = time.perf_counter() - start
+
+        file_name = os.path.join(tempfile.mkdtemp(), "fleet.csv")
+        save_csv(file_name, smart_homes)
+        start = time.perf_counter()
+        executor.submit(load_csv, file_name).result()
+        csv_read_time = time.perf_counter() - start
+
+    publisher.close()
+
+    print(f"Shared memory with {number_of_homes} homes and {number_of_devices} devices:")
+    print(f"Publish: {publish_time:.3f}s, tracked update: {update_time * 1000000:.1f}us")
+    print(f"Reader process total load: {shared_load} (expected {expected_load}) in {shared_read_time:.3f}s")
+    print(f"Reader process loading the CSV instead: {csv_read_time:.3f}s")
+
+
+#benchmark_shared_state()
@@ -0,0 +1,238 @@
+import gc
+import hashlib
+import marshal
+import os
+import struct
+import time
+from array import array
+from backend import SmartPlug, SmartTV, SmartWashingMachine, SmartHome, SparseSmartHome
+from savefile import iter_device_slots
+
+
+# A snapshot is SNAPSHOT_HEADER_FORMAT: magic b"SHSN", format version, the source save's
+# st_mtime_ns and size and a blake2b digest of its bytes, followed by a marshal image of
+# flat fleet-wide columns: next_smart_home_id, home names, max_items, whether each home is
+# a SparseSmartHome and its device count (unsigned 32-bit each), then one byte per device for the type code, one
+# for the state (2 for a default placeholder of a sparse home) and an unsigned short per
+# device for the value, the same values the shared memory segment uses. The image is only
+# used while the source save still matches all three, so a save edited or replaced since
+# is loaded from the CSV again.
+SNAPSHOT_MAGIC = b"SHSN"
+SNAPSHOT_FORMAT_VERSION = 2
+SNAPSHOT_HEADER_FORMAT = "<4sHxxqQ32s"
+SNAPSHOT_HEADER_SIZE = struct.calcsize(SNAPSHOT_HEADER_FORMAT)
+PLACEHOLDER_STATE = 2
+
+DEVICE_CLASSES_BY_CODE = {device_class.type_code: device_class for device_class in (SmartPlug, SmartTV, SmartWashingMachine)}
+
+
+def snapshot_file_name_for(source_file_name):
+    return f"{source_file_name}.snapshot"
+
+
+def source_signature(source_file_name):
+    file_stat = os.stat(source_file_name)
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+def file_digest(file_name, chunk_size=1024 * 1024):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(file_name, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def snapshot_image(smart_homes_dict, next_smart_home_id):
+    # raises ValueError for a home that doesn't fit the columns
+    try:
+        return build_snapshot_image(smart_homes_dict, next_smart_home_id)
+    except OverflowError as e:
+        raise ValueError(f"Fleet does not fit into a snapshot: {e}")
+
+
+def build_snapshot_image(smart_homes_dict, next_smart_home_id):
+    max_items = array("I")
+    sparse = bytearray()
+    device_counts = array("I")
+    type_codes = bytearray()
+    states = bytearray()
+    values = array("H")
+
+    for smart_home in smart_homes_dict.values():
+        max_items.append(smart_home.max_items)
+        sparse.append(isinstance(smart_home, SparseSmartHome))
+        number_of_devices = 0
+
+        for slot in iter_device_slots(smart_home):
+            number_of_devices += 1
+            type_codes.append(slot.type_code)
+            if isinstance(slot, type):
+                states.append(PLACEHOLDER_STATE)
+                values.append(0)
+                continue
+
+            states.append(slot.switched_on)
+            if isinstance(slot, SmartPlug):
+                values.append(slot.consumption_rate)
+            elif isinstance(slot, SmartTV):
+                values.append(slot.channel)
+            else:
+                values.append(slot.wash_mode_code)
+        device_counts.append(number_of_devices)
+
+    return (
+        next_smart_home_id, list(smart_homes_dict), max_items.tobytes(), bytes(sparse),
+        device_counts.tobytes(), bytes(type_codes), bytes(states), values.tobytes()
+    )
+
+
+def state_from_snapshot_image(image):
+    # the values were valid when they were written, so the devices are filled in directly
+    # instead of going through the validating setters, in one pass over the whole fleet
+    next_smart_home_id, smart_home_names, max_items_bytes, sparse, device_counts_bytes, type_codes, states, values_bytes = image
+    max_items = array("I")
+    max_items.frombytes(max_items_bytes)
+    device_counts = array("I")
+    device_counts.frombytes(device_counts_bytes)
+    values = array("H")
+    values.frombytes(values_bytes)
+
+    device_classes = [None] * (max(DEVICE_CLASSES_BY_CODE) + 1)
+    for type_code, device_class in DEVICE_CLASSES_BY_CODE.items():
+        device_classes[type_code] = device_class
+
+    # power_before[i] is the switched on plug draw of all devices before device i
+    new_device = object.__new__
+    devices = []
+    append_device = devices.append
+    power_before = [0]
+    append_power = power_before.append
+    current_power = 0
+    for type_code, device_state, value in zip(type_codes, states, values):
+        device_class = device_classes[type_code]
+        if device_state == PLACEHOLDER_STATE:
+            append_device(device_class)
+            append_power(current_power)
+            continue
+
+        device = new_device(device_class)
+        if device_class is SmartPlug:
+            device._consumption_rate = value
+            if device_state:
+                current_power += value
+        elif device_class is SmartTV:
+            device._channel = value
+        else:
+            device._wash_mode_code = value
+        device._switched_on = device_state == 1
+        append_device(device)
+        append_power(current_power)
+
+    smart_homes = {}
+    first_device = 0
+    for smart_home_name, home_max_items, home_sparse, number_of_devices in zip(
+        smart_home_names, max_items, sparse, device_counts
+    ):
+        smart_home = SparseSmartHome(home_max_items) if home_sparse else SmartHome(home_max_items)
+        last_device = first_device + number_of_devices
+        smart_home._devices = devices[first_device:last_device]
+        smart_home._current_power = power_before[last_device] - power_before[first_device]
+        smart_homes[smart_home_name] = smart_home
+        first_device = last_device
+
+    return {"smart_homes": smart_homes, "next_smart_home_id": next_smart_home_id}
+
+
+def write_snapshot(source_file_name, smart_homes_dict, next_smart_home_id, snapshot_file_name=None):
+    # smart_homes_dict has to hold the same homes as the source save right now
+    snapshot_file_name = snapshot_file_name or snapshot_file_name_for(source_file_name)
+    mtime_ns, size = source_signature(source_file_name)
+    digest = file_digest(source_file_name)
+
+    payload = marshal.dumps(snapshot_image(smart_homes_dict, next_smart_home_id))
+    header = struct.pack(SNAPSHOT_HEADER_FORMAT, SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, mtime_ns, size, digest)
+
+    temp_file_name = f"{snapshot_file_name}.tmp"
+    with open(temp_file_name, "wb") as file:
+        file.write(header)
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file_name, snapshot_file_name)
+
+    return SNAPSHOT_HEADER_SIZE + len(payload)
+
+
+def read_snapshot(source_file_name, snapshot_file_name=None):
+    # the manager state dictionary, or None when there is no snapshot or it is stale,
+    # unreadable or corrupt, the caller then loads the save itself
+    snapshot_file_name = snapshot_file_name or snapshot_file_name_for(source_file_name)
+    try:
+        with open(snapshot_file_name, "rb") as file:
+            data = file.read()
+        mtime_ns, size = source_signature(source_file_name)
+        source_digest = file_digest(source_file_name)
+    except OSError:
+        return None
+
+    if len(data) < SNAPSHOT_HEADER_SIZE:
+        return None
+    magic, format_version, snapshot_mtime_ns, snapshot_size, digest = struct.unpack_from(
+        SNAPSHOT_HEADER_FORMAT, data, 0
+    )
+    if magic != SNAPSHOT_MAGIC or format_version != SNAPSHOT_FORMAT_VERSION:
+        return None
+    if (snapshot_mtime_ns, snapshot_size) != (mtime_ns, size) or source_digest != digest:
+        return None
+
+    # nothing built here can form a cycle, so the collector only slows the bulk build down
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return state_from_snapshot_image(marshal.loads(memoryview(data)[SNAPSHOT_HEADER_SIZE:]))
+    except (EOFError, ValueError, TypeError, IndexError):
+        return None
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def benchmark_snapshot(number_of_homes=200000):
+    import tempfile
+    from fleetgen import FleetGenerator
+    from savefile import load_csv, smart_home_id
+
+    file_name = os.path.join(tempfile.mkdtemp(), "fleet.csv")
+    FleetGenerator(seed=1).write_fleet(file_name, number_of_homes)
+
+    start = time.perf_counter()
+    smart_homes_dict = load_csv(file_name)
+    cold_time = time.perf_counter() - start
+
+    next_smart_home_id = max(smart_home_id(smart_home_name) for smart_home_name in smart_homes_dict) + 1
+    start = time.perf_counter()
+    snapshot_size = write_snapshot(file_name, smart_homes_dict, next_smart_home_id)
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    state = read_snapshot(file_name)
+    warm_time = time.perf_counter() - start
+
+    same_state = all(
+        str(smart_home) == str(state["smart_homes"][smart_home_name])
+        for smart_home_name, smart_home in smart_homes_dict.items()
+    )
+
+    # touching the save has to make the snapshot stale
+    os.utime(file_name)
+    stale = read_snapshot(file_name) is None
+
+    print(f"Restoring {number_of_homes} homes ({os.path.getsize(file_name) / 1024 / 1024:.1f}MiB CSV):")
+    print(f"Cold CSV load: {cold_time:.2f}s")
+    print(f"Snapshot: {snapshot_size / 1024 / 1024:.1f}MiB written in {write_time:.2f}s")
+    print(f"Warm snapshot load with validation: {warm_time:.2f}s, {cold_time / warm_time:.1f}x faster")
+    print(f"Same state: {same_state}, snapshot stale after touching the save: {stale}")
+
+
+#benchmark_snapshot()
@@ -0,0 +1,323 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+from backend import SmartHome
+from savefile import device_value, create_device, save_csv, load_csv
+
+
+# SQLite builds before 3.32 allow at most 999 ? placeholders in one statement
+MAX_QUERY_PARAMETERS = 999
+
+class SQLiteStore:
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # autocommit mode, transactions are opened explicitly in transaction()
+        self.connection = sqlite3.connect(file_name, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.transaction_depth = 0
+        self.attached = {}
+        self.create_tables()
+
+    def create_tables(self):
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS homes (
+                name TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                max_items INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS devices (
+                home TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                type TEXT NOT NULL,
+                switched_on INTEGER NOT NULL,
+                value TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_homes_position ON homes(position);
+            CREATE INDEX IF NOT EXISTS idx_devices_home ON devices(home, position);
+            CREATE INDEX IF NOT EXISTS idx_devices_type ON devices(type);
+            CREATE INDEX IF NOT EXISTS idx_devices_state ON devices(switched_on);
+        """)
+
+    def close(self):
+        for smart_home_name in list(self.attached):
+            self.detach(smart_home_name)
+        self.connection.close()
+
+    @contextmanager
+    def transaction(self):
+        # nested calls join the outermost transaction
+        if self.transaction_depth == 0:
+            self.connection.execute("BEGIN")
+        self.transaction_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                self.connection.execute("ROLLBACK")
+            raise
+        self.transaction_depth -= 1
+        if self.transaction_depth == 0:
+            self.connection.execute("COMMIT")
+
+    def count_homes(self):
+        return self.connection.execute("SELECT COUNT(*) FROM homes").fetchone()[0]
+
+    def home_names(self):
+        rows = self.connection.execute("SELECT name FROM homes ORDER BY position")
+        return [row[0] for row in rows]
+
+    def next_position(self):
+        row = self.connection.execute("SELECT MAX(position) FROM homes").fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def device_rows(self, smart_home):
+        return [
+            (type(device).__name__, int(device.switched_on), device_value(device))
+            for device in smart_home.devices
+        ]
+
+    def save_home(self, smart_home_name, smart_home):
+        with self.transaction():
+            row = self.connection.execute(
+                "SELECT position FROM homes WHERE name = ?", (smart_home_name,)
+            ).fetchone()
+            position = self.next_position() if row is None else row[0]
+
+            self.connection.execute(
+                "INSERT OR REPLACE INTO homes (name, position, max_items) VALUES (?, ?, ?)",
+                (smart_home_name, position, smart_home.max_items)
+            )
+            self.write_devices(smart_home_name, smart_home)
+
+    def save_homes(self, smart_homes):
+        # bulk insert, one transaction and one executemany per table
+        with self.transaction():
+            position = self.next_position()
+            home_rows = []
+            device_rows = []
+
+            for smart_home_name, smart_home in smart_homes:
+                home_rows.append((smart_home_name, position, smart_home.max_items))
+                for i, (device_type, device_state, value) in enumerate(self.device_rows(smart_home)):
+                    device_rows.append((smart_home_name, i, device_type, device_state, value))
+                position += 1
+
+            self.connection.executemany(
+                "DELETE FROM devices WHERE home = ?",
+                [(row[0],) for row in home_rows]
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO homes (name, position, max_items) VALUES (?, ?, ?)",
+                home_rows
+            )
+            self.connection.executemany(
+                "INSERT INTO devices (home, position, type, switched_on, value) VALUES (?, ?, ?, ?, ?)",
+                device_rows
+            )
+
+    def write_devices(self, smart_home_name, smart_home):
+        self.connection.execute("DELETE FROM devices WHERE home = ?", (smart_home_name,))
+        self.connection.executemany(
+            "INSERT INTO devices (home, position, type, switched_on, value) VALUES (?, ?, ?, ?, ?)",
+            [
+                (smart_home_name, i, device_type, device_state, value)
+                for i, (device_type, device_state, value) in enumerate(self.device_rows(smart_home))
+            ]
+        )
+
+    def delete_home(self, smart_home_name):
+        self.detach(smart_home_name)
+        with self.transaction():
+            self.connection.execute("DELETE FROM devices WHERE home = ?", (smart_home_name,))
+            self.connection.execute("DELETE FROM homes WHERE name = ?", (smart_home_name,))
+
+    def clear(self):
+        for smart_home_name in list(self.attached):
+            self.detach(smart_home_name)
+        with self.transaction():
+            self.connection.execute("DELETE FROM devices")
+            self.connection.execute("DELETE FROM homes")
+
+    def build_homes(self, home_rows):
+        if not home_rows:
+            return []
+
+        smart_homes = {}
+        for smart_home_name, max_items in home_rows:
+            smart_homes[smart_home_name] = SmartHome(max_items)
+
+        smart_home_names = [row[0] for row in home_rows]
+        for start in range(0, len(smart_home_names), MAX_QUERY_PARAMETERS):
+            names = smart_home_names[start:start + MAX_QUERY_PARAMETERS]
+            placeholders = ",".join("?" * len(names))
+            device_rows = self.connection.execute(
+                f"SELECT home, type, switched_on, value FROM devices WHERE home IN ({placeholders}) ORDER BY home, position",
+                names
+            )
+            for smart_home_name, device_type, device_state, value in device_rows:
+                device = create_device(device_type, bool(device_state), value)
+                smart_homes[smart_home_name].add_device(device)
+
+        return list(smart_homes.items())
+
+    def load_home(self, smart_home_name):
+        row = self.connection.execute(
+            "SELECT name, max_items FROM homes WHERE name = ?", (smart_home_name,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(smart_home_name)
+        return self.build_homes([row])[0][1]
+
+    def page_homes(self, offset, limit):
+        home_rows = self.connection.execute(
+            "SELECT name, max_items FROM homes ORDER BY position LIMIT ? OFFSET ?",
+            (limit, offset)
+        ).fetchall()
+        return self.build_homes(home_rows)
+
+    def iter_homes(self, page_size=MAX_QUERY_PARAMETERS):
+        offset = 0
+        while True:
+            page = self.page_homes(offset, page_size)
+            if not page:
+                return
+            yield from page
+            offset += page_size
+
+    def count_devices(self, device_type=None, switched_on=None):
+        query = "SELECT COUNT(*) FROM devices WHERE 1 = 1"
+        parameters = []
+        if device_type is not None:
+            query += " AND type = ?"
+            parameters.append(device_type)
+        if switched_on is not None:
+            query += " AND switched_on = ?"
+            parameters.append(int(switched_on))
+        return self.connection.execute(query, parameters).fetchone()[0]
+
+    def homes_with_device(self, device_type, switched_on=None):
+        query = "SELECT DISTINCT home FROM devices WHERE type = ?"
+        parameters = [device_type]
+        if switched_on is not None:
+            query += " AND switched_on = ?"
+            parameters.append(int(switched_on))
+        return [row[0] for row in self.connection.execute(query, parameters)]
+
+    # write-through: an attached SmartHome writes every mutation to the database
+
+    def attach(self, smart_home_name, smart_home):
+        self.detach(smart_home_name)
+
+        def listener(smart_home, event, index, device):
+            self.write_through(smart_home_name, smart_home, event, index, device)
+
+        smart_home.listeners.append(listener)
+        self.attached[smart_home_name] = (smart_home, listener)
+
+    def detach(self, smart_home_name):
+        if smart_home_name in self.attached:
+            smart_home, listener = self.attached.pop(smart_home_name)
+            if listener in smart_home.listeners:
+                smart_home.listeners.remove(listener)
+
+    def write_through(self, smart_home_name, smart_home, event, index, device):
+        with self.transaction():
+            if event == "update":
+                self.connection.execute(
+                    "UPDATE devices SET switched_on = ?, value = ? WHERE home = ? AND position = ?",
+                    (int(device.switched_on), device_value(device), smart_home_name, index)
+                )
+            elif event == "add":
+                self.connection.execute(
+                    "INSERT INTO devices (home, position, type, switched_on, value) VALUES (?, ?, ?, ?, ?)",
+                    (smart_home_name, index, type(device).__name__, int(device.switched_on), device_value(device))
+                )
+            elif event == "remove":
+                self.connection.execute(
+                    "DELETE FROM devices WHERE home = ? AND position = ?",
+                    (smart_home_name, index)
+                )
+                self.connection.execute(
+                    "UPDATE devices SET position = position - 1 WHERE home = ? AND position > ?",
+                    (smart_home_name, index)
+                )
+            elif event == "update_all":
+                self.connection.executemany(
+                    "UPDATE devices SET switched_on = ? WHERE home = ? AND position = ?",
+                    [(int(device.switched_on), smart_home_name, i) for i, device in enumerate(smart_home.devices)]
+                )
+            elif event == "max_items":
+                self.connection.execute(
+                    "UPDATE homes SET max_items = ? WHERE name = ?",
+                    (smart_home.max_items, smart_home_name)
+                )
+            else:
+                # "replace" (e.g. from a delta import) can change max_items along with the devices
+                self.connection.execute(
+                    "UPDATE homes SET max_items = ? WHERE name = ?",
+                    (smart_home.max_items, smart_home_name)
+                )
+                self.write_devices(smart_home_name, smart_home)
+
+
+def benchmark_storage(number_of_homes=10000, number_of_updates=1000):
+    import os
+    import tempfile
+    from fleetgen import FleetGenerator
+
+    smart_homes = dict(FleetGenerator(seed=1).generate_fleet(number_of_homes))
+
+    directory = tempfile.mkdtemp()
+    csv_file_name = os.path.join(directory, "state.csv")
+    db_file_name = os.path.join(directory, "state.db")
+
+    start = time.perf_counter()
+    save_csv(csv_file_name, smart_homes.items())
+    csv_save_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_csv(csv_file_name)
+    csv_load_time = time.perf_counter() - start
+
+    # a durable single device change on the CSV path means rewriting the file
+    start = time.perf_counter()
+    for i in range(10):
+        smart_homes[f"Smart Home {i+1}"].toggle_device(0)
+        save_csv(csv_file_name, smart_homes.items())
+    csv_update_time = (time.perf_counter() - start) / 10
+
+    store = SQLiteStore(db_file_name)
+
+    start = time.perf_counter()
+    store.save_homes(smart_homes.items())
+    db_save_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    list(store.iter_homes())
+    db_load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store.page_homes(number_of_homes // 2, 20)
+    db_page_time = time.perf_counter() - start
+
+    names = list(smart_homes)
+    for smart_home_name in names[:number_of_updates]:
+        store.attach(smart_home_name, smart_homes[smart_home_name])
+
+    start = time.perf_counter()
+    for smart_home_name in names[:number_of_updates]:
+        smart_homes[smart_home_name].toggle_device(0)
+    db_update_time = (time.perf_counter() - start) / number_of_updates
+
+    store.close()
+
+    print(f"Benchmark with {number_of_homes} homes:")
+    print(f"CSV save: {csv_save_time:.3f}s, load: {csv_load_time:.3f}s, point update: {csv_update_time * 1000:.3f}ms")
+    print(f"SQLite save: {db_save_time:.3f}s, load: {db_load_time:.3f}s, point update: {db_update_time * 1000:.3f}ms")
+    print(f"SQLite page of 20 homes: {db_page_time * 1000:.3f}ms")
+
+
+#benchmark_storage()
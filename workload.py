@@ -0,0 +1,236 @@
+import json
+import math
+import os
+import time
+from backend import create_default_smart_home
+from savefile import iter_csv, save_csv, open_save_file
+
+
+# A trace is a header line {"format": 1, "started": unix time} followed by one JSON array
+# per operation: [seconds since the recording started, operation, smart_home_name, *arguments].
+# Values typed into the UI are recorded as the raw strings, so a replay goes through the
+# same conversions and validation the UI did. Traces ending in .gz or .xz are compressed.
+TRACE_FORMAT_VERSION = 1
+
+TRACE_OPERATIONS = (
+    "add_home",
+    "remove_home",
+    "toggle_device",
+    "switch_all_on",
+    "switch_all_off",
+    "update_option",
+    "add_device",
+    "remove_device",
+    "load_save",
+    "save_state",
+)
+
+REPLAY_ERRORS = (ValueError, TypeError, IndexError, KeyError, AttributeError, OSError)
+
+
+class TraceRecorder:
+
+    def __init__(self, file_name, compression=None, clock=time.perf_counter, flush_every=100, flush_interval=1.0):
+        # the trace is flushed every flush_every operations or flush_interval seconds, so a
+        # crashed or killed session loses at most that much of its end (.xz can't be flushed
+        # part way, so use .gz or plain traces for sessions that may not close cleanly)
+        self.file_name = file_name
+        self.clock = clock
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.file = open_save_file(file_name, "w", compression)
+        self.start_time = clock()
+        self.operations_recorded = 0
+        self.file.write(json.dumps({"format": TRACE_FORMAT_VERSION, "started": time.time()}) + "\n")
+        self.file.flush()
+        self.last_flush_time = self.start_time
+        self.operations_since_flush = 0
+
+    def record(self, operation, smart_home_name=None, *arguments):
+        if operation not in TRACE_OPERATIONS:
+            raise ValueError(f"Unknown trace operation: {operation}")
+
+        now = self.clock()
+        elapsed = round(now - self.start_time, 6)
+        self.file.write(json.dumps([elapsed, operation, smart_home_name, *arguments], separators=(",", ":")) + "\n")
+        self.operations_recorded += 1
+
+        self.operations_since_flush += 1
+        if self.operations_since_flush >= self.flush_every or now - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.file.flush()
+        self.last_flush_time = self.clock()
+        self.operations_since_flush = 0
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def iter_trace(file_name):
+    # yields (elapsed, operation, smart_home_name, arguments)
+    with open_save_file(file_name, "r") as file:
+        header = json.loads(file.readline())
+        if header.get("format") != TRACE_FORMAT_VERSION:
+            raise ValueError("Unsupported trace format")
+
+        # a session that crashed leaves a compressed trace without its end marker and maybe a
+        # half written last line, everything up to there is still replayed
+        try:
+            for line in file:
+                if not line.endswith("\n"):
+                    break
+                if line.strip():
+                    elapsed, operation, smart_home_name, *arguments = json.loads(line)
+                    yield elapsed, operation, smart_home_name, arguments
+        except EOFError:
+            return
+
+
+def percentile(sorted_values, fraction):
+    # nearest rank
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class TraceReplayer:
+
+    # re-executes a trace against plain SmartHome objects, no window is needed
+    def __init__(self, smart_homes_dict=None, output_directory=None, sparse=False):
+        self.smart_homes_dict = {} if smart_homes_dict is None else smart_homes_dict
+        self.sparse = sparse
+
+        # saves in the trace are written here instead of over the operator's files
+        if output_directory is None:
+            import tempfile
+            output_directory = tempfile.mkdtemp()
+        self.output_directory = output_directory
+
+        self.latencies = {}
+        self.errors = {}
+
+    def apply(self, operation, smart_home_name, arguments):
+        if operation == "load_save":
+            self.smart_homes_dict.clear()
+            self.smart_homes_dict.update(iter_csv(arguments[0], sparse=self.sparse))
+            return
+        elif operation == "save_state":
+            file_name = os.path.join(self.output_directory, os.path.basename(arguments[0]))
+            save_csv(file_name, list(self.smart_homes_dict.items()), sparse=self.sparse)
+            return
+        elif operation == "add_home":
+            self.smart_homes_dict[smart_home_name] = create_default_smart_home()
+            return
+        elif operation == "remove_home":
+            del self.smart_homes_dict[smart_home_name]
+            return
+
+        smart_home = self.smart_homes_dict[smart_home_name]
+        if operation == "toggle_device":
+            smart_home.toggle_device(arguments[0])
+        elif operation == "switch_all_on":
+            smart_home.switch_all_on()
+        elif operation == "switch_all_off":
+            smart_home.switch_all_off()
+        elif operation == "update_option":
+            index, value = arguments
+            if type(smart_home.get_device(index)).__name__ != "SmartWashingMachine":
+                value = smart_home.attempt_conversion_to_int(value)
+            smart_home.update_option(index, value)
+        elif operation == "add_device":
+            device_type, value = arguments
+            smart_home.add_device(smart_home.input_validation(device_type, value))
+        elif operation == "remove_device":
+            smart_home.remove_device(arguments[0])
+        else:
+            raise ValueError(f"Unknown trace operation: {operation}")
+
+    def replay(self, file_name, real_time=False, speed=1.0):
+        # as fast as possible, or real_time=True to keep the recorded gaps (divided by speed)
+        start = time.perf_counter()
+
+        for elapsed, operation, smart_home_name, arguments in iter_trace(file_name):
+            if real_time:
+                delay = elapsed / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            operation_start = time.perf_counter()
+            try:
+                self.apply(operation, smart_home_name, arguments)
+            except REPLAY_ERRORS:
+                # the operator saw the same error, the replay carries on like the UI did
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+            self.latencies.setdefault(operation, []).append(time.perf_counter() - operation_start)
+
+        return time.perf_counter() - start
+
+    def report(self):
+        # latencies in milliseconds per operation
+        report = {}
+        for operation, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            report[operation] = {
+                "count": len(latencies),
+                "errors": self.errors.get(operation, 0),
+                "p50": percentile(latencies, 0.5) * 1000,
+                "p90": percentile(latencies, 0.9) * 1000,
+                "p99": percentile(latencies, 0.99) * 1000,
+                "max": latencies[-1] * 1000,
+            }
+        return report
+
+
+def benchmark_trace_replay(number_of_homes=200, number_of_steps=100000):
+    import random
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    file_name = os.path.join(directory, "workload.trace.gz")
+
+    # an operator session: homes added, lots of toggles and edits, a few saves
+    random.seed(1)
+    recorder = TraceRecorder(file_name)
+    names = [f"Smart Home {i + 1}" for i in range(number_of_homes)]
+    for smart_home_name in names:
+        recorder.record("add_home", smart_home_name)
+    for i in range(number_of_steps):
+        smart_home_name = random.choice(names)
+        option = random.random()
+        if option < 0.5:
+            recorder.record("toggle_device", smart_home_name, random.randrange(3))
+        elif option < 0.8:
+            recorder.record("update_option", smart_home_name, 0, str(random.randint(1, 800)))
+        elif option < 0.9:
+            recorder.record("add_device", smart_home_name, "SmartPlug", str(random.randint(0, 150)))
+        elif option < 0.99:
+            recorder.record("remove_device", smart_home_name, 3)
+        else:
+            recorder.record("save_state", None, "fleet.csv")
+    recorder.close()
+
+    replayer = TraceReplayer(output_directory=directory)
+    elapsed = replayer.replay(file_name)
+    again = TraceReplayer(output_directory=directory)
+    again.replay(file_name)
+
+    print(f"Replayed {number_of_homes + number_of_steps} operations ({os.path.getsize(file_name) / 1024:.0f}KiB trace) in {elapsed:.2f}s:")
+    for operation, stats in replayer.report().items():
+        print(
+            f"{operation}: {stats['count']} ops, {stats['errors']} errors, p50 {stats['p50']:.3f}ms, "
+            f"p90 {stats['p90']:.3f}ms, p99 {stats['p99']:.3f}ms, max {stats['max']:.3f}ms"
+        )
+
+    same_state = all(
+        str(replayer.smart_homes_dict[smart_home_name]) == str(again.smart_homes_dict[smart_home_name])
+        for smart_home_name in names
+    )
+    print(f"Replays end in the same state: {same_state}")
+
+
+#benchmark_trace_replay()